@@ -1,6 +1,7 @@
 import flask
 
 from pg_discuss import ext
+from pg_discuss import identity
 from pg_discuss import queries
 
 
@@ -25,21 +26,27 @@ class AuthTktIdentityPolicy(ext.IdentityPolicy):
                               True)
 
     def remember(self, request, identity_id, **extras):
-        # Update cookie
-        flask.session['identity_id'] = identity_id
+        # Update cookie, only if the identity has changed, so that the session
+        # is not rewritten on every request.
+        if flask.session.get('identity_id') != identity_id:
+            flask.session['identity_id'] = identity_id
 
     def get_identity(self, request, **extras):
+        # The identity is only fetched, or created, when it is used, so that
+        # anonymous requests which only read comments do not insert an
+        # identity each.
         identity_id = flask.session.get('identity_id')
-        from flask import current_app
         if identity_id:
-            try:
-                return queries.fetch_identity(identity_id)
-            # If we have a cookie, but no matching identity in the db,
-            # create a new identity and reset cookie.
-            except queries.IdentityNotFoundError:
-                return queries.insert_identity()
-        else:
-            current_app.logger.error(identity_id)
+            return identity.LazyIdentity(
+                lambda: self._fetch_or_insert_identity(identity_id))
+        return identity.LazyIdentity(queries.insert_identity, new=True)
+
+    def _fetch_or_insert_identity(self, identity_id):
+        try:
+            return identity.fetch_identity(identity_id)
+        # If we have a cookie, but no matching identity in the db,
+        # create a new identity and reset cookie.
+        except queries.IdentityNotFoundError:
             return queries.insert_identity()
 
     def forget(self, request, **extras):
@@ -9,12 +9,13 @@ CAPTURE_AUTHOR_ALLOW_EDIT = False
 
 
 class CaptureAuthor(ext.AppExtBase, ext.ValidateComment,
-                    ext.OnPreCommentSerialize):
+                    ext.OnPreCommentsSerialize):
     """Extension to capture and persist the author field from the HTTP API.
 
     Enables a setting, `CAPTURE_AUTHOR_ALLOW_EDIT`, which when True,
     allows the author field to be edited by the Identity which posted.
     """
+    serialized_fields = {'author': _compat.string_types}
 
     def init_app(self, app):
         self._app = app
@@ -31,6 +32,9 @@ class CaptureAuthor(ext.AppExtBase, ext.ValidateComment,
                 )
         return comment
 
-    def on_pre_comment_serialize(self, raw_comment, client_comment, **extras):
-        if 'author' in raw_comment['custom_json']:
-            client_comment['author'] = raw_comment['custom_json']['author']
+    def on_pre_comments_serialize(self, raw_comments, client_comments,
+                                  **extras):
+        for raw_comment, client_comment in zip(raw_comments, client_comments):
+            custom_json = raw_comment['custom_json']
+            if 'author' in custom_json:
+                client_comment['author'] = custom_json['author']
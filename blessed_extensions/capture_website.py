@@ -9,8 +9,10 @@ from pg_discuss import _compat
 from pg_discuss import ext
 
 
-class CaptureWebsite(ext.ValidateComment, ext.OnPreCommentSerialize):
+class CaptureWebsite(ext.ValidateComment, ext.OnPreCommentsSerialize):
     """Extension to capture and persist the website from the HTTP API."""
+    serialized_fields = {'website': _compat.string_types}
+
     def validate_comment(self, comment, action, **extras):
         website = flask.request.get_json().get('website')
         if website:
@@ -19,9 +21,12 @@ class CaptureWebsite(ext.ValidateComment, ext.OnPreCommentSerialize):
             comment['custom_json']['website'] = normalize_url(url)
         return comment
 
-    def on_pre_comment_serialize(self, raw_comment, client_comment, **extras):
-        if 'website' in raw_comment['custom_json']:
-            client_comment['website'] = raw_comment['custom_json']['website']
+    def on_pre_comments_serialize(self, raw_comments, client_comments,
+                                  **extras):
+        for raw_comment, client_comment in zip(raw_comments, client_comments):
+            custom_json = raw_comment['custom_json']
+            if 'website' in custom_json:
+                client_comment['website'] = custom_json['website']
 
 
 def normalize_url(url):
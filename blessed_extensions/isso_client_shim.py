@@ -2,23 +2,35 @@ import codecs
 import datetime
 import functools
 
+import flask
 from flask import request
 import pytz
 import simplejson as json
 import werkzeug
 import werkzeug.security
 
+from pg_discuss import _compat
 from pg_discuss import ext
+from pg_discuss import queries
+from pg_discuss import tree
+from pg_discuss import utils
 
 
-class IssoClientShim(ext.AppExtBase, ext.OnPreCommentSerialize,
-                     ext.OnPreThreadSerialize, ext.OnPreCommentInsert,
-                     ext.OnNewCommentResponse):
+class IssoClientShim(ext.AppExtBase, ext.OnPreCommentsSerialize,
+                     ext.OnPreThreadFetch, ext.OnPreThreadSerialize,
+                     ext.OnPreCommentInsert, ext.OnNewCommentResponse):
     """Extension to adapt JSON API to format used by Isso JavaScript client.
 
     If extensions that add edit/delete views are enabled, they must be loaded
     before this extension.
     """
+    serialized_fields = {
+        'parent': int,
+        'likes': int,
+        'dislikes': int,
+        'hash': _compat.string_types,
+        'mode': int,
+    }
 
     def init_app(self, app):
         # Disable all pretty-printing. Flask will not disable it since
@@ -41,21 +53,38 @@ class IssoClientShim(ext.AppExtBase, ext.OnPreCommentSerialize,
         app.route('/id/<int:comment_id>/dislike', methods=['POST'])(
             self.dislike_)
 
-    def on_pre_comment_serialize(self, raw_comment, client_comment, **extras):
-        # Change `parent_id` key to `parent`
-        client_comment['parent'] = raw_comment.pop('parent_id')
-
-        # Change `upvotes` to `likes`, `downvotes` to `dislikes`
-        if 'upvotes' in client_comment:
-            client_comment['likes'] = client_comment.pop('upvotes')
-        if 'downvotes' in client_comment:
-            client_comment['dislikes'] = client_comment.pop('downvotes')
-
-        client_comment['hash'] = raw_comment['custom_json'].get('hash')
-
-        # Set "mode" to 4 for deleted comments
-        if raw_comment['custom_json'].get('deleted'):
-            client_comment['mode'] = 4
+    def on_pre_comments_serialize(self, raw_comments, client_comments,
+                                  **extras):
+        for raw_comment, client_comment in zip(raw_comments, client_comments):
+            # Change `parent_id` key to `parent`
+            client_comment['parent'] = raw_comment.pop('parent_id')
+
+            # Change `upvotes` to `likes`, `downvotes` to `dislikes`
+            if 'upvotes' in client_comment:
+                client_comment['likes'] = client_comment.pop('upvotes')
+            if 'downvotes' in client_comment:
+                client_comment['dislikes'] = client_comment.pop('downvotes')
+
+            custom_json = raw_comment['custom_json']
+            client_comment['hash'] = custom_json.get('hash')
+
+            # Set "mode" to 4 for deleted comments
+            if custom_json.get('deleted'):
+                client_comment['mode'] = 4
+
+    def on_pre_thread_fetch(self, fetch_options, **extras):
+        # Prune the comment tree in the database, starting from the replies
+        # to the `parent` comment, if requested, created after `after`. Other
+        # extensions may use the `parent_id` option to fetch only the
+        # subtree.
+        parent_id = get_int_arg('parent')
+        if parent_id is not None:
+            fetch_options['parent_id'] = parent_id
+        after = get_after()
+        if after is not None:
+            fetch_options['after'] = after
+        fetch_options['reply_limit'] = get_reply_limit()
+        fetch_options['depth_limit'] = get_int_arg('nested_limit')
 
     def on_pre_thread_serialize(self, raw_thread, comment_seq, client_thread,
                                 **extras):
@@ -64,52 +93,17 @@ class IssoClientShim(ext.AppExtBase, ext.OnPreCommentSerialize,
         # direct descendants that will be returned for each node,
         # and `nested_limit` is treated as a limit to the depth of replies
         # returned.
-        after = None
-        try:
-            # Because of a regression in Python 3, we must jump through
-            # some hoops to correctly convert a Decimal string representing
-            # a fractional Unix timestamp to a Datetime object.
-            # See: https://bugs.python.org/issue23607
-            # Naively using floats will result in comparison errors.
-            after_str = request.args.get('after')
-            if after_str:
-                try:
-                    seconds_str, ms_str = after_str.split('.')
-                except ValueError:
-                    seconds_str = after_str
-                    ms_str = None
-
-                after = datetime.datetime.fromtimestamp(
-                    int(seconds_str),
-                    tz=pytz.utc)
-                if ms_str:
-                    td = datetime.timedelta(microseconds=int(ms_str))
-                    after = after + td
-        except TypeError:
-            pass
-
-        try:
-            reply_limit = int(request.args.get('limit'))
-        except TypeError:
-            reply_limit = None
-
-        try:
-            reply_depth_limit = int(request.args.get('nested_limit'))
-        except TypeError:
-            reply_depth_limit = None
-
-        try:
-            parent_id = int(request.args.get('parent'))
-        except TypeError:
-            parent_id = None
-
-        # Change key to comment collection from "comments" to "replies"
-        comment_tree = build_comment_tree(
+        reply_limit = get_reply_limit()
+        reply_depth_limit = get_int_arg('nested_limit')
+
+        # Change key to comment collection from "comments" to "replies".
+        # The tree was pruned in the database by `on_pre_thread_fetch`.
+        comment_tree = build_pruned_comment_tree(
             comment_seq=comment_seq,
-            parent_id=parent_id,
-            after=after,
+            parent_id=get_int_arg('parent'),
+            reply_count=raw_thread['reply_count'],
+            comment_annotations=raw_thread['comment_annotations'],
             reply_limit=reply_limit,
-            count_limit=None,
             reply_depth_limit=reply_depth_limit,
         )
         client_thread.update(comment_tree)
@@ -186,9 +180,24 @@ class IssoClientShim(ext.AppExtBase, ext.OnPreCommentSerialize,
         return resp
 
     def count(self):
-        """Not implemented, stubbed to satisfy client.
+        """Count the comments of each thread in the JSON list of thread ids
+        in the request body, and respond with the list of counts in the same
+        order. Used by the Isso client's `count.js`.
         """
-        return '[]'
+        # The client does not send a JSON `Content-Type`.
+        thread_client_ids = request.get_json(force=True, silent=True)
+        if (
+            not isinstance(thread_client_ids, list)
+            or not all(isinstance(cid, _compat.string_types)
+                       for cid in thread_client_ids)
+        ):
+            flask.abort(400, 'Request body must be a JSON list of thread ids')
+        counts = queries.count_comments_by_thread_client_ids(
+            thread_client_ids)
+        return self.app.response_class(
+            json.dumps([counts.get(cid, 0) for cid in thread_client_ids]),
+            mimetype='application/json',
+        )
 
     def like_(self, comment_id):
         resp = self.app.view_functions['upvote'](comment_id)
@@ -199,6 +208,39 @@ class IssoClientShim(ext.AppExtBase, ext.OnPreCommentSerialize,
         return rename_voting_keys(resp)
 
 
+def get_int_arg(name):
+    """Get an integer request argument, or None if not given."""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        flask.abort(400, 'Invalid `{0}` argument'.format(name))
+
+
+def get_reply_limit():
+    """Get the `limit` request argument. A limit of 0 means no limit."""
+    return get_int_arg('limit') or None
+
+
+def get_after():
+    """Get the `after` request argument, a fractional Unix timestamp, as
+    a timezone-aware Datetime object, or None if not given.
+    """
+    after_str = request.args.get('after')
+    if not after_str:
+        return None
+    # Parse the decimal string, rather than a float, to get the exact
+    # microseconds. See: https://bugs.python.org/issue23607
+    # Timestamps out of the range of `datetime` are also invalid.
+    try:
+        after = utils.timestamp_to_datetime(after_str)
+    except ValueError:
+        flask.abort(400, 'Invalid `after` timestamp')
+    return after.replace(tzinfo=pytz.utc)
+
+
 def rename_voting_keys(resp):
     d = json.loads(resp.get_data())
     d['likes'] = d.pop('upvotes')
@@ -207,192 +249,53 @@ def rename_voting_keys(resp):
     return resp
 
 
-def build_comment_tree(comment_seq,
-                       parent_id=None,
-                       index=0,
-                       after=None,
-                       reply_limit=None,
-                       count_limit=None,
-                       reply_depth_limit=None):
-    """Build the nested tree of comments, counting the number of replies to
-    each comments as we go. Our goal is to have the subtree of comments
-    that belong to the parent, starting at the specified index, with up
-    to `count_limit` replies, sorted by chronological order, and no
-    replies at a depth greater than `reply_depth_limit`. All this processing is
-    expensive, but is a fairly intuitive way of selecting a subtree to allow
-    for both incrementally loading long, flat threads as well as digging deeper
-    into highly nested comments.
-
-    We assume that the sequence of
-    comments has been sorted by `created` time, which enables us to construct
-    the tree by iterating over the list sequentially.
-
-    Pagination:
-    `parent` is the parent comment we want to retrieve nested comments for.
-    If `parent` is None, then we assume we are retrieving the top-level
-    comments.
-    `index` is the index relative to the chronologically ordered set of
-    comments to a parent (or, the top-level comments).
+def build_pruned_comment_tree(comment_seq,
+                              reply_count,
+                              comment_annotations,
+                              parent_id=None,
+                              reply_limit=None,
+                              reply_depth_limit=None):
+    """Build the nested tree of comments from a sequence of comments that
+    has already been pruned to `reply_limit` and `reply_depth_limit` by
+    :func:`pg_discuss.queries.fetch_thread_tree_by_client_id`.
+
+    Each comment is annotated with its `reply_count` of all descendants, and
+    `after_count` of all later siblings and their descendants, using the
+    counts in `comment_annotations` that were computed over the whole thread
+    in the database. Comments beyond the depth limit are annotated with their
+    count of `deeper_replies`, and comments with replies beyond the reply
+    limit with their count of `hidden_replies`. The roots of the tree are the
+    replies to the requested `parent_id`, if any. The tree is built and
+    walked by :mod:`pg_discuss.tree`.
     """
-    # Construct the full tree, starting from the parent.
-    # Once we have the full tree starting from the parent, we can
-    # sort/annotate/prune it however we like.
-    comment_tree = construct_full_tree(comment_seq, parent_id)
-
-    # Find index of the first comment created after `after`
-    if after:
-        for i, comment in enumerate(comment_tree['replies']):
-            if comment['created'] > after:
-                index = max(i, 0)
-                break
-
-    # We start by discarding all comments up to `index`.
-    del comment_tree['replies'][:index]
-    # We can now descend the tree and annotate each node with counts
-    # of its descendants and later siblings+sibling descendants.
-    annotate_counts(comment_tree)
-
-    # We need to discard any nodes at a depth greater than `reply_depth_limit`.
-    discard_beyond_depth_limit(comment_tree, depth_limit=reply_depth_limit)
-
-    # Keep only the first `reply_limit` nodes for each subtree.
-    # This ensures that there are not more than `reply_limit` replies
-    # returned for any given comment.
-    if reply_limit:
-        keep_reply_limit(comment_tree, reply_limit)
-
-    # Keep only the first `count_limit` nodes by chronology.
-    # This puts an absolute limit on the number of comments returned.
-    if count_limit:
-        keep_count_limit(comment_tree, count_limit)
-
-    return comment_tree
-
-
-def construct_full_tree(comment_seq, parent_id=None):
-    """Construct the full tree, given an ordered sequence of comments."""
-    comment_tree = {'replies': []}
-    comment_dict = {}
+    # Comments are sorted by `created` time, so each comment comes after its
+    # parent.
+    comment_tree = tree.build(comment_seq, parent_id)
+    comment_tree['reply_count'] = reply_count
 
     for c in comment_seq:
-        # Track which comment is the desired parent, if supplied.
-        if parent_id and c['id'] == parent_id:
-            parent = c
-
-        c['replies'] = []
-        # Index the comment into the dictionary by id.
-        comment_dict[c['id']] = c
-        # Increment the total comment count.
-
-        # If no parent_id, must be a top-level comment.
-        if not c['parent_id']:
-            comment_tree['replies'].append(c)
-
-        # Otherwise, this is a nested comment, and we append it to the replies
-        # of the parent, using the map to look up the parent. The parent is
-        # guaranteed to exist in the map, since our `comment_seq` array is
-        # sorted by `created` time.
-        else:
-            comment_dict[c['parent_id']]['replies'].append(c)
-
-    # Return the tree starting with the desired parent, if supplied.
-    if parent_id:
-        return parent
-    # Else, return the complete tree.
-    return comment_tree
-
+        annotations = comment_annotations[c['id']]
+        c['reply_count'] = annotations['reply_count']
+        c['after_count'] = annotations['after_count']
+        # Replies of comments beyond the depth limit were not fetched.
+        if (
+            reply_depth_limit is not None
+            and annotations['depth'] > reply_depth_limit
+        ):
+            del c['replies']
+            c['deeper_replies'] = c['reply_count']
+
+    # If replies were discarded beyond the `reply_limit`, the last kept reply
+    # has a count of the discarded replies and their descendants.
+    if reply_limit:
+        for n, depth in tree.walk(comment_tree):
+            replies = n.get('replies')
+            if replies and len(replies) == reply_limit:
+                num_discarded = replies[-1]['after_count']
+                if num_discarded:
+                    n['hidden_replies'] = num_discarded
 
-def annotate_counts(node):
-    """Recursive function to annotate each node with the count of all
-    of it's descendants, as well as the count of all sibling comments plus
-    their children, made after each node.
-    """
-    # If no replies, this is a leaf node. Stop and return 1.
-    node['reply_count'] = 0
-    if not node['replies']:
-        return 1
-    else:
-        # Annotate descendants and sum counts.
-        for r in node['replies']:
-            node['reply_count'] += annotate_counts(r)
-        # Once descendants are annotated with descendant counts,
-        # annotate with the count of siblings and their children coming after
-        # this node.
-        after_count = 0
-        for r in reversed(node['replies']):
-            r['after_count'] = after_count
-            after_count += r['reply_count'] + 1
-        return node['reply_count'] + 1
-
-
-def keep_reply_limit(node, reply_limit):
-    """Keep only the first `count_limit` nodes by chronology."""
-    def walk_tree_and_discard(n):
-        # Discard any direct descendants beyond the `reply_limit`.
-        if 'replies' in n:
-            if len(n['replies']) > reply_limit:
-                hidden_replies = n.get('hidden_replies', 0)
-                c = n['replies'][reply_limit]
-                num_discarded = c['after_count'] + c['reply_count'] + 1
-                n['hidden_replies'] = hidden_replies + num_discarded
-
-                del n['replies'][reply_limit:]
-
-            # Recursively check the remaining replies.
-            for r in n['replies']:
-                walk_tree_and_discard(r)
-    walk_tree_and_discard(node)
-
-
-def keep_count_limit(node, count_limit):
-    """Keep only the first `count_limit` nodes by chronology."""
-    # First, we need to find the `created` time of the `count_limit`-th node.
-    created_times = []
-
-    def walk_tree_for_created(n):
-        created = n.get('created')
-        if created:
-            created_times.append(n['created'])
-        if 'replies' in n:
-            for r in n['replies']:
-                walk_tree_for_created(r)
-
-    walk_tree_for_created(node)
-
-    created_times.sort()
-
-    keep_time = created_times[count_limit]
-
-    def walk_tree_and_discard(n):
-        # Discard any direct descendants that are greater than the time.
-        if 'replies' in n:
-            len_replies = len(n['replies'])
-            num_discarded = 0
-            for i in range(len_replies - 1, -1, -1):
-                c = n['replies'][i]
-                if c['created'] > keep_time:
-                    num_discarded += c['after_count'] + c['reply_count'] + 1
-                    del n['replies'][i]
-
-            hidden_replies = n.get('hidden_replies', 0)
-            n['hidden_replies'] = hidden_replies + num_discarded
-
-        # Recursively check the remaining replies.
-        for r in n['replies']:
-            walk_tree_and_discard(r)
-    walk_tree_and_discard(node)
-
-
-def discard_beyond_depth_limit(node, depth_limit, cur_depth=0):
-    """Discard nodes beyond the depth limit. The root is considered "level 0",
-    and the first descendants are "level 1".
-    """
-    if cur_depth > depth_limit:
-        del node['replies']
-        node['deeper_replies'] = node['reply_count']
-    else:
-        for r in node['replies']:
-            discard_beyond_depth_limit(r, depth_limit, cur_depth + 1)
+    return comment_tree
 
 
 def hash(val):
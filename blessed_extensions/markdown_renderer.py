@@ -40,8 +40,25 @@ class MarkdownRenderer(ext.CommentRenderer):
 
         renderer = misaka.HtmlRenderer(flags=render_flags_int)
         self.markdown = misaka.Markdown(renderer, extensions=extensions_int)
+        self._render_key = '{0}:{1}:{2}'.format(
+            super(MarkdownRenderer, self).render_key(),
+            render_flags_int,
+            extensions_int,
+        )
 
     def render(self, text, **extras):
         """Render Markdown to HTML.
         """
         return self.markdown(text)
+
+    def render_many(self, texts, **extras):
+        """Render a sequence of Markdown texts to HTML, without the overhead
+        of a method call for each text.
+        """
+        markdown = self.markdown
+        return [markdown(text) for text in texts]
+
+    def render_key(self, **extras):
+        """Key including the render and extension flags.
+        """
+        return self._render_key
@@ -0,0 +1,87 @@
+import sqlalchemy as sa
+
+from pg_discuss import ext
+from pg_discuss import tables
+
+#: Number of hex digits for each comment id in a path.
+PATH_SEGMENT_WIDTH = 8
+
+
+class MaterializedPath(ext.AppExtBase, ext.OnPreCommentInsert,
+                       ext.OnPreThreadFetch):
+    """Extension to maintain a materialized path for each comment, so that
+    the subtree of a comment can be fetched in display order with a single
+    range scan of an index.
+
+    The path is stored in `custom_json` as the concatenation of the ids of
+    the comment's ancestors and the comment itself, each as a zero-padded hex
+    string. Sorting by path in the "C" collation orders each comment before
+    its replies, and replies by id.
+
+    Requires the ext migration which adds the index on `thread_id` and `path`,
+    and backfills the path of existing comments. Must be loaded after
+    extensions that set the `parent_id` fetch option, or change the
+    `custom_json` of new comments.
+    """
+
+    def init_app(self, app):
+        pass
+
+    def on_pre_comment_insert(self, new_comment, **extras):
+        # The path includes the comment's own id, so the id is taken from the
+        # sequence up front, and the path is computed from it as the comment
+        # is inserted. See `pg_discuss.queries.comment_insert_chain`.
+        t = tables.comment
+        custom_json = new_comment['custom_json']
+        new_comment['id'] = sa.func.nextval(
+            sa.func.pg_get_serial_sequence(t.name, t.c.id.name))
+
+        def custom_json_with_path(row):
+            parent = t.alias('parent')
+            parent_path = (
+                sa.select([parent.c.custom_json['path'].astext])
+                .where(parent.c.id == row.parent_id)
+                .as_scalar()
+            )
+            path = sa.func.coalesce(parent_path, '') + path_segment(row.id)
+            return sa.func.jsonb_set(
+                sa.cast(sa.bindparam('custom_json', custom_json,
+                                     type_=t.c.custom_json.type),
+                        t.c.custom_json.type),
+                '{path}',
+                sa.func.to_jsonb(path),
+            )
+        new_comment['custom_json'] = custom_json_with_path
+
+    def on_pre_thread_fetch(self, fetch_options, **extras):
+        parent_id = fetch_options.get('parent_id')
+        if parent_id is None:
+            return
+        # Fetch the parent and its descendants: the comments whose path has
+        # the parent's path as a prefix. Since paths consist of hex digits,
+        # these are the paths from the parent's path (inclusive) to the
+        # parent's path followed by 'g' (exclusive).
+        t = tables.comment
+        parent = t.alias('parent')
+        parent_path = (
+            sa.select([comment_path(parent)])
+            .where(parent.c.id == parent_id)
+            .as_scalar()
+        )
+        fetch_options.setdefault('predicates', []).append(sa.and_(
+            comment_path(t) >= parent_path,
+            comment_path(t) < parent_path + 'g',
+        ))
+        fetch_options['order_by'] = comment_path(t)
+
+
+def comment_path(t):
+    """Get the path of comments in the table `t`, in the "C" collation of the
+    index.
+    """
+    return sa.collate(t.c.custom_json['path'].astext, 'C')
+
+
+def path_segment(comment_id):
+    """Get the path segment for a comment id."""
+    return sa.func.lpad(sa.func.to_hex(comment_id), PATH_SEGMENT_WIDTH, '0')
@@ -7,9 +7,10 @@ import sqlalchemy as sa
 
 from . import admin
 from pg_discuss import ext
+from pg_discuss import invalidation
 from pg_discuss import models
+from pg_discuss import queries
 from pg_discuss import tables
-from pg_discuss.db import db
 
 #: Enable moderation by setting new posts to `pending`.
 MODERATION_ACTIVE = True
@@ -107,21 +108,20 @@ class CommentAdminWithModeration(admin.AuthenticatedModelView):
             action_text = 'rejected'
 
         try:
-            t = tables.comment
             mod_mode = sa.func.jsonb_set(
                 sa.text('custom_json'),
                 sa.text("'{mod_mode}'"),
                 sa.text('\'"{}"\''.format(jsonb_val))
             )
-            stmt = (
-                t.update()
-                .where(t.c.id.in_(ids))
-                .values(custom_json=mod_mode)
-                .returning(t.c.id)
-            )
-            result = db.engine.execute(stmt).fetchall()
+            result = queries.update_comments_visibility(
+                ids, {'custom_json': mod_mode})
             count = len(result)
 
+            thread_ids = set(row[1] for row in result)
+            invalidation.publish(
+                *[('comment', row[0]) for row in result]
+                + [('thread', thread_id) for thread_id in thread_ids])
+
             flask.flash(ngettext(
                 'Comment was successfully {}.'
                 .format(action_text),
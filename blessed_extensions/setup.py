@@ -63,6 +63,7 @@ if __name__ == '__main__':
                 'blessed_admin = blessed_extensions.admin:AdminExt',
                 'blessed_moderation = blessed_extensions.moderation:ModerationExt',
                 'blessed_mod_email = blessed_extensions.mod_email:ModerationEmail',
+                'blessed_materialized_path = blessed_extensions.materialized_path:MaterializedPath',
                 'blessed_profiler = blessed_extensions.profiler:ProfilerExt',
                 'blessed_proxyfix = blessed_extensions.proxyfix:ProxyFixExt',
             ],
@@ -10,7 +10,13 @@ EPOCH = datetime.datetime(1970, 1, 1, 0, 0, 0, 0, tzinfo=pytz.utc)
 
 class UnixTimeJSONEncoder(json.JSONEncoder):
     """JSON encoder driver to encode datetime values as Unix timestamps.
+
+    The timestamps of fetched comments are computed in the database, so that
+    only other datetimes need to be converted by `default`.
     """
+    #: See :func:`pg_discuss.serialize.wants_epoch_times`.
+    wants_epoch_times = True
+
     def default(self, obj):
         if isinstance(obj, datetime.datetime):
             return (obj - EPOCH).total_seconds()
@@ -1,6 +1,7 @@
 import flask
 
 from pg_discuss import ext
+from pg_discuss import invalidation
 from pg_discuss import queries
 from pg_discuss import tables
 from pg_discuss.db import db
@@ -8,12 +9,13 @@ from pg_discuss.db import db
 import sqlalchemy as sa
 
 
-class Voting(ext.AppExtBase, ext.OnPreCommentSerialize):
+class Voting(ext.AppExtBase, ext.OnPreCommentsSerialize):
     """Extension to enable upvotes/downvotes on comments. Votes counts
     are stored directly on comment object for performance reasons, but
     :class:`pg_discuss.models.IdentityComment` are used to tie votes
     to an Identity.
     """
+    serialized_fields = {'upvotes': int, 'downvotes': int}
 
     def init_app(self, app):
         app.route('/comments/<int:comment_id>/upvote', methods=['POST'])(
@@ -73,10 +75,17 @@ class Voting(ext.AppExtBase, ext.OnPreCommentSerialize):
             .values(custom_json=incremented)
             .returning(
                 t.c.custom_json['upvotes'],
-                t.c.custom_json['downvotes']
+                t.c.custom_json['downvotes'],
+                t.c.thread_id,
             )
         )
-        statements = [ins, upd]
+        # Increment the version of the comment's thread.
+        thread_id = (
+            sa.select([t.c.thread_id])
+            .where(t.c.id == sa.bindparam('vote_comment_id', comment_id))
+        )
+        bump = queries.thread_version_bump(thread_id)
+        statements = [ins, bump, upd]
         stmt, bindparams = queries.cte_chain(statements)
         try:
             results = db.engine.execute(stmt, **bindparams).first()
@@ -86,6 +95,7 @@ class Voting(ext.AppExtBase, ext.OnPreCommentSerialize):
                 'Cannot {0} on comment: identity has already submitted {0}'
                 .format(vote_type)
             )
+        invalidation.publish(('comment', comment_id), ('thread', results[2]))
 
         resp_obj = {
             'upvotes': results[0],
@@ -93,10 +103,9 @@ class Voting(ext.AppExtBase, ext.OnPreCommentSerialize):
         }
         return flask.jsonify(resp_obj)
 
-    def on_pre_comment_serialize(self, raw_comment, client_comment, **extras):
-        client_comment['upvotes'] = (
-            raw_comment['custom_json'].get('upvotes', 0)
-        )
-        client_comment['downvotes'] = (
-            raw_comment['custom_json'].get('downvotes', 0)
-        )
+    def on_pre_comments_serialize(self, raw_comments, client_comments,
+                                  **extras):
+        for raw_comment, client_comment in zip(raw_comments, client_comments):
+            custom_json = raw_comment['custom_json']
+            client_comment['upvotes'] = custom_json.get('upvotes', 0)
+            client_comment['downvotes'] = custom_json.get('downvotes', 0)
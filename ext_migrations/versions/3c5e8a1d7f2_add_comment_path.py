@@ -0,0 +1,69 @@
+"""Add materialized comment path
+
+Revision ID: 3c5e8a1d7f2
+Revises: 18d88bc2c83
+Create Date: 2026-10-18 00:10:39.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3c5e8a1d7f2'
+down_revision = '18d88bc2c83'
+
+from alembic import op
+import sqlalchemy as sa
+
+#: Size of the range of comment ids to backfill with each batch.
+BATCH_SIZE = 1000
+
+
+def upgrade():
+    # Backfill the path of existing comments in batches of ranges of ids.
+    # Only comments whose parent already has a path are updated, since the
+    # path set on a parent is not visible to the statement which sets it, so
+    # each range is updated until it is done, working down the tree. Replies
+    # have greater ids than their parents, so the parents outside of a range
+    # are done by the earlier ranges.
+    backfill = sa.text('''
+UPDATE comment AS c
+SET custom_json = jsonb_set(c.custom_json, '{path}', to_jsonb(
+    coalesce(
+        (SELECT p.custom_json->>'path' FROM comment AS p
+         WHERE p.id = c.parent_id),
+        ''
+    ) || lpad(to_hex(c.id), 8, '0')
+))
+WHERE c.id >= :start AND c.id < :stop
+AND NOT c.custom_json ? 'path'
+AND (c.parent_id IS NULL OR EXISTS (
+    SELECT 1 FROM comment AS p
+    WHERE p.id = c.parent_id AND p.custom_json ? 'path'
+))
+''')
+    bind = op.get_bind()
+    min_id, max_id = bind.execute(
+        'SELECT min(id), max(id) FROM comment').first()
+    # Commit each statement, so that the updated rows are not locked, and the
+    # old versions of the rows can be vacuumed, until the end of the
+    # migration.
+    with op.get_context().autocommit_block():
+        if min_id is not None:
+            for start in range(min_id, max_id + 1, BATCH_SIZE):
+                while bind.execute(
+                    backfill, start=start, stop=start + BATCH_SIZE
+                ).rowcount:
+                    pass
+
+    op.get_bind().execute('''
+CREATE INDEX _comment_thread_id_path
+ON comment (thread_id, (custom_json->>'path') COLLATE "C");
+''')
+
+
+def downgrade():
+    op.get_bind().execute('''
+DROP INDEX _comment_thread_id_path
+''')
+    op.get_bind().execute('''
+UPDATE comment SET custom_json = custom_json - 'path'
+''')
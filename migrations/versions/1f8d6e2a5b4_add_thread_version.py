@@ -0,0 +1,24 @@
+"""Add version counter to thread
+
+Revision ID: 1f8d6e2a5b4
+Revises: 4e1a9b3c2d7
+Create Date: 2026-10-18 12:20:53.901724
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1f8d6e2a5b4'
+down_revision = '4e1a9b3c2d7'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('thread',
+                  sa.Column('version', sa.Integer(), server_default='0',
+                            nullable=False))
+
+
+def downgrade():
+    op.drop_column('thread', 'version')
@@ -0,0 +1,23 @@
+"""Add index for keyset pagination of comments
+
+Revision ID: 2b7f4c1d9e3
+Revises: 46a03f51647
+Create Date: 2026-10-18 10:12:41.530218
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2b7f4c1d9e3'
+down_revision = '46a03f51647'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_comment_thread_id_created_id', 'comment',
+                    ['thread_id', 'created', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_comment_thread_id_created_id', table_name='comment')
@@ -0,0 +1,26 @@
+"""Add rendered text columns to comment
+
+Revision ID: 4e1a9b3c2d7
+Revises: 2b7f4c1d9e3
+Create Date: 2026-10-18 11:02:17.284411
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4e1a9b3c2d7'
+down_revision = '2b7f4c1d9e3'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('comment',
+                  sa.Column('rendered_text', sa.String(), nullable=True))
+    op.add_column('comment',
+                  sa.Column('rendered_key', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('comment', 'rendered_key')
+    op.drop_column('comment', 'rendered_text')
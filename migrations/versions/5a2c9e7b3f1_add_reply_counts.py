@@ -0,0 +1,42 @@
+"""Add counts of visible comments to thread and comment
+
+Revision ID: 5a2c9e7b3f1
+Revises: 1f8d6e2a5b4
+Create Date: 2026-10-18 14:02:37.215480
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5a2c9e7b3f1'
+down_revision = '1f8d6e2a5b4'
+
+from alembic import op
+import sqlalchemy as sa
+
+from pg_discuss import ext
+from pg_discuss import queries
+from pg_discuss import tables
+
+
+def upgrade():
+    op.add_column('thread',
+                  sa.Column('comment_count', sa.Integer(), server_default='0',
+                            nullable=False))
+    op.add_column('comment',
+                  sa.Column('reply_count', sa.Integer(), server_default='0',
+                            nullable=False))
+
+    # Count the visible comments of the existing threads, with the same
+    # statements as `pgd-admin recount_replies`. The counts depend on which
+    # extensions hide comments, so the predicates of the configured
+    # extensions are used.
+    predicates = ext.exec_hooks(ext.AddCommentFilterPredicate)
+    bind = op.get_bind()
+    for stmt in queries.reply_recount(
+            sa.select([tables.thread.c.id]), predicates):
+        bind.execute(stmt)
+
+
+def downgrade():
+    op.drop_column('comment', 'reply_count')
+    op.drop_column('thread', 'comment_count')
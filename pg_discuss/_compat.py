@@ -12,6 +12,12 @@ except ImportError:  # pragma: no cover
     # python 3
     from urllib.parse import urlparse  # NOQA
 
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:  # pragma: no cover
+    # python 2
+    from collections import Mapping, MutableMapping  # NOQA
+
 from functools import reduce
 
 PY3 = sys.version_info[0] == 3
@@ -21,10 +27,12 @@ if PY3:  # pragma: no cover
     text_type = str
     string_types = (str,)
     unquote = urllib.parse.unquote
+    RecursionError = RecursionError
 else:  # pragma: no cover
     text_type = unicode  # NOQA
     string_types = (str, unicode)  # NOQA
     unquote = urllib.unquote
+    RecursionError = RuntimeError
 
 
 def to_bytes(text):
@@ -1,7 +1,6 @@
 """Factory function for the WSGI application object.
 """
 import os
-import sys
 
 import flask
 import flask_login
@@ -11,10 +10,16 @@ import stevedore
 
 from . import _compat
 from . import auth_forms
+from . import cache
+from . import commands
 from . import config
 from . import ext
 from . import identity
+from . import invalidation
 from . import models
+from . import records
+from . import render_pool
+from . import serialize
 from . import views
 from .db import db
 
@@ -45,9 +50,6 @@ def app_factory():
     if custom_settings and os.path.isfile(custom_settings):
         app.config.from_pyfile(custom_settings)
 
-    # Set the recursion limit
-    sys.setrecursionlimit(app.config['PYTHON_RECURSION_LIMIT'])
-
     # Flask-SQLAlchemy
     db.init_app(app)
 
@@ -59,6 +61,10 @@ def app_factory():
     app.script_manager.add_command('db', flask_migrate.MigrateCommand)
     app.script_manager.add_command('createadminuser',
                                    auth_forms.CreateAdminUser)
+    app.script_manager.add_command('render_comments',
+                                   commands.RenderComments)
+    app.script_manager.add_command('recount_replies',
+                                   commands.RecountReplies)
 
     # Flask-Login, for Admin users.
     app.admin_login_manager = flask_login.LoginManager(app)
@@ -88,16 +94,27 @@ def app_factory():
         name=app.config['DRIVER_COMMENT_RENDERER'],
     )
     app.comment_renderer = app.comment_renderer_loader.driver(app)
+    # Render large batches of comments in a pool of worker processes.
+    if app.config['RENDER_POOL_PROCESSES']:
+        app.comment_renderer = render_pool.PooledRenderer(
+            app.comment_renderer,
+            app.config['RENDER_POOL_PROCESSES'],
+            app.config['RENDER_POOL_THRESHOLD'],
+            app=app,
+        )
 
     # Load configured JSONEncoder driver
     app.json_encoder_loader = stevedore.DriverManager(
         namespace='pg_discuss.ext',
         name=app.config['DRIVER_JSON_ENCODER'],
     )
-    app.json_encoder = app.json_encoder_loader.driver
+    # Extend the driver to encode the compact records of bulk comment
+    # processing.
+    app.json_encoder = records.json_encoder(app.json_encoder_loader.driver)
 
     # Exempt public read-only views from IdentityPolicy
     app.identity_policy_mgr.exempt(views.fetch)
+    app.identity_policy_mgr.exempt(views.fetch_page)
     app.identity_policy_mgr.exempt(views.view)
 
     # Default routes. Other routes must be added through App extensions.
@@ -105,6 +122,8 @@ def app_factory():
     # can introspect/modify view functions.
     app.route('/threads/<thread_cid>/comments', methods=['GET'])(views.fetch)
     app.route('/threads/<thread_cid>/comments', methods=['POST'])(views.new)
+    app.route('/threads/<thread_cid>/comments/page', methods=['GET'])(
+        views.fetch_page)
     app.route('/comments/<int:comment_id>', methods=['GET'])(views.view)
     app.route('/comments/<int:comment_id>', methods=['PATCH'])(views.edit)
     app.route('/comments/<int:comment_id>', methods=['DELETE'])(views.delete)
@@ -124,9 +143,36 @@ def app_factory():
     # Create hook map
     app.hook_map = ext.get_hook_map(app.ext_mgr.extensions, ext.hook_classes())
 
+    # Create the bus to publish changes to in-process caches.
+    invalidation.init_app(app)
+
+    # Create the cache of encoded thread responses.
+    app.thread_cache = cache.LRUCache(app.config['THREAD_CACHE_MAX_BYTES'])
+    app.invalidation_bus.subscribe(
+        'thread', app.thread_cache.invalidate, app.thread_cache.clear)
+
+    # Create the cache of identities, by id.
+    app.identity_cache = cache.TTLCache(
+        app.config['IDENTITY_CACHE_MAX_ENTRIES'],
+        app.config['IDENTITY_CACHE_TTL'],
+    )
+    app.invalidation_bus.subscribe(
+        'identity', app.identity_cache.invalidate, app.identity_cache.clear)
+
     # Run the `init_app` hooks.
     ext.exec_init_app(app)
 
+    # Compile the comment serializer for the configured extensions, with a
+    # cache of the encoded comments.
+    app.fragment_cache = cache.LRUCache(
+        app.config['COMMENT_FRAGMENT_CACHE_MAX_BYTES'])
+    app.comment_serializer = serialize.CommentSerializer(
+        [e.obj for e in app.ext_mgr.extensions],
+        app.comment_renderer,
+        fragment_cache=app.fragment_cache,
+        encoder=serialize.get_json_encoder(app),
+    )
+
     # Add a route to the landing page at the root, '/'. Ignore if an extension
     # has already set up a route for the root.
     try:
@@ -0,0 +1,160 @@
+"""In-process caches.
+
+Cached values are tagged, for example with a thread id, so that all values
+derived from an object can be invalidated when the object changes. Caches are
+invalidated by subscribing to change events on the
+:mod:`pg_discuss.invalidation` bus.
+"""
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    """Least-recently-used cache bounded by the total size in bytes of its
+    values, rather than by the number of entries.
+
+    The size of each value must be given when it is set. A cache with a
+    `max_bytes` of 0 is disabled, and never stores any values.
+
+    Values computed from the database may be stale if an invalidation occurs
+    while they are being computed. To guard against this, read `generation`
+    before computing a value and pass it to `set`: the value will only be
+    stored if no invalidation has occurred in the meantime.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.generation = 0
+        # Map of key to (value, size, tag), in least-recently-used order.
+        self._entries = collections.OrderedDict()
+        # Map of tag to the set of keys with the tag.
+        self._tags = collections.defaultdict(set)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Get the value for `key`, marking it as most recently used."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self._entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value, size, tag=None, generation=None):
+        """Set the value for `key`, evicting least recently used values as
+        needed to stay within `max_bytes`.
+
+        Returns True if the value was stored. Values larger than `max_bytes`
+        are not stored, nor are values computed before the last invalidation
+        if `generation` is given.
+        """
+        if not self.max_bytes or size > self.max_bytes:
+            return False
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return False
+            self._discard(key)
+            while self.size + size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+            self._entries[key] = (value, size, tag)
+            self.size += size
+            if tag is not None:
+                self._tags[tag].add(key)
+            return True
+
+    def invalidate(self, tag):
+        """Discard all values with the given `tag`."""
+        with self._lock:
+            self.generation += 1
+            for key in list(self._tags.get(tag, ())):
+                self._discard(key)
+
+    def clear(self):
+        """Discard all values."""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._tags.clear()
+            self.size = 0
+
+    def _discard(self, key):
+        """Discard the value for `key`, if any. Must hold the lock."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        _, size, tag = entry
+        self.size -= size
+        if tag is not None:
+            keys = self._tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+
+class TTLCache(object):
+    """Cache bounded by the number of entries, whose values expire `ttl`
+    seconds after they are set.
+
+    The least recently set values are evicted first. A cache with a
+    `max_entries` of 0 is disabled, and never stores any values. As for
+    :class:`LRUCache`, pass the `generation` read before computing a value
+    to `set`, so that values computed before an invalidation are not stored.
+    """
+
+    def __init__(self, max_entries, ttl, clock=time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.generation = 0
+        self._clock = clock
+        # Map of key to (value, expiry time), in the order they were set.
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Get the value for `key`, unless it has expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if self._clock() >= expires:
+                del self._entries[key]
+                return default
+            return value
+
+    def set(self, key, value, generation=None):
+        """Set the value for `key`, evicting the least recently set value if
+        the cache is full.
+
+        Returns True if the value was stored.
+        """
+        if not self.max_entries:
+            return False
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return False
+            self._entries.pop(key, None)
+            while len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+            self._entries[key] = (value, self._clock() + self.ttl)
+            return True
+
+    def invalidate(self, key):
+        """Discard the value for `key`, if any."""
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Discard all values."""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
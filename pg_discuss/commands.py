@@ -0,0 +1,103 @@
+"""Flask-Script commands provided by the pg-discuss core.
+"""
+import flask
+import flask_script
+
+from . import invalidation
+from . import queries
+
+
+class RenderComments(flask_script.Command):
+    """Flask-Script command to render the stored text of comments with the
+    configured `CommentRenderer`.
+
+    Should be run after changing the renderer driver or its configuration.
+    Comments with stale rendered text are still displayed correctly, but are
+    rendered again on every read until this command is run. The version of
+    the thread of each rendered comment is incremented, and cached copies of
+    the thread are invalidated.
+
+    Progress is logged to the app logger.
+    """
+
+    option_list = (
+        flask_script.Option('--all', dest='render_all', action='store_true',
+                            default=False,
+                            help='Render all comments, not only stale ones.'),
+        flask_script.Option('--batch-size', dest='batch_size', type=int,
+                            default=1000,
+                            help='Number of comments to render per batch.'),
+    )
+
+    def run(self, render_all, batch_size):
+        """Render comments in batches of `batch_size`."""
+        app = flask.current_app
+        renderer = app.comment_renderer
+        render_key = renderer.render_key()
+        after_id = None
+        count = 0
+
+        while True:
+            rows = queries.fetch_comments_to_render(
+                render_key,
+                after_id=after_id,
+                limit=batch_size,
+                render_all=render_all,
+            )
+            if not rows:
+                break
+            rendered_texts = renderer.render_many([text for _, text in rows])
+            thread_ids = queries.update_rendered_texts([{
+                'comment_id': comment_id,
+                'rendered_text': rendered_text,
+                'rendered_key': render_key,
+            } for (comment_id, _), rendered_text in zip(rows, rendered_texts)])
+            publish_threads(thread_ids)
+            after_id = rows[-1][0]
+            count += len(rows)
+            app.logger.info('Rendered %d comments', count)
+
+
+class RecountReplies(flask_script.Command):
+    """Flask-Script command to recompute the stored counts of shown comments
+    of each thread, and of shown replies to each comment.
+
+    Should be run after enabling or disabling extensions which hide comments,
+    such as moderation. Comments written while the command is running may
+    not be counted. The version of each recounted
+    thread is incremented, and cached copies of the thread are invalidated.
+
+    Progress is logged to the app logger.
+    """
+
+    option_list = (
+        flask_script.Option('--batch-size', dest='batch_size', type=int,
+                            default=100,
+                            help='Number of threads to recount per batch.'),
+    )
+
+    def run(self, batch_size):
+        """Recount threads in batches of `batch_size`."""
+        app = flask.current_app
+        after_id = None
+        count = 0
+
+        while True:
+            thread_ids = queries.fetch_thread_ids(
+                after_id=after_id, limit=batch_size)
+            if not thread_ids:
+                break
+            queries.recount_replies(thread_ids)
+            publish_threads(thread_ids)
+            after_id = thread_ids[-1]
+            count += len(thread_ids)
+            app.logger.info('Recounted %d threads', count)
+
+
+def publish_threads(thread_ids):
+    """Publish a `thread` event for each of the threads. Events are published
+    one at a time, since a single notification of a large batch of threads
+    could exceed the size limit of a Postgres notification payload.
+    """
+    for thread_id in thread_ids:
+        invalidation.publish(('thread', thread_id))
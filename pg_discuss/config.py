@@ -7,10 +7,6 @@ All connection parameters and secrets should be read from the environment.
 import os
 import logging
 
-#: Python recursion limit. This determines at what level of comment nesting
-#: the JSON encoder will hit "RuntimeError: maximum recursion depth exceeded".
-PYTHON_RECURSION_LIMIT = 30000
-
 #: Flask-SQLAlchemy can track object modifications. Disable because of
 #: memory overhead.
 SQLALCHEMY_TRACK_MODIFICATIONS = False
@@ -64,6 +60,8 @@ ENABLE_EXT_BLESSED_VOTING = True
 ENABLE_EXT_BLESSED_MODERATION = False
 #:
 ENABLE_EXT_BLESSED_MOD_EMAIL = False
+#: Requires the `ext_migrations` to backfill the path of existing comments.
+ENABLE_EXT_BLESSED_MATERIALIZED_PATH = False
 #:
 ENABLE_EXT_BLESSED_PROFILER = False
 #:
@@ -79,6 +77,7 @@ EXT_ORDER = (
     'blessed_admin,'
     'blessed_moderation,'
     'blessed_isso_client_shim,'
+    'blessed_materialized_path,'
 )
 
 # Driver settings
@@ -89,6 +88,66 @@ DRIVER_JSON_ENCODER = 'blessed_unix_time_json_encoder'
 #: Identity driver to use (as a setuptools entrypoint name)
 DRIVER_IDENTITY_POLICY = 'blessed_auth_tkt_identity_policy'
 
+#: Number of worker processes to render the comments of large threads in
+#: parallel, in each app process. Set to 0 to render all comments in the app
+#: process. The pool is off by default: the Markdown renderer takes about 10
+#: microseconds per comment, and the pool was not reliably faster for any
+#: batch size up to 33000 comments in `tests/perf/render_pool.py`.
+RENDER_POOL_PROCESSES = 0
+#: Minimum number of comments to render in a fetch for the rendering to be
+#: split across the worker processes. Smaller batches are rendered in the app
+#: process. There is no default crossover point: before enabling the pool,
+#: measure it for the renderer and machine with `tests/perf/render_pool.py`.
+RENDER_POOL_THRESHOLD = 0
+
+# Response settings
+#: Minimum number of comments in a thread for the fetch response to be
+#: streamed to the client as it is encoded, rather than encoded in full before
+#: sending. Streaming bounds the memory needed to encode very large threads.
+#: Set to None to disable streaming.
+STREAMING_RESPONSE_THRESHOLD = 1000
+#: Approximate size in bytes of each chunk written to the client when
+#: streaming a response.
+STREAMING_RESPONSE_CHUNK_SIZE = 65536
+#: Number of comments read from the database at a time when streaming the
+#: comments of a thread from a server-side cursor.
+COMMENT_STREAM_BATCH_SIZE = 1000
+
+#: Default number of comments per page for the paginated fetch API.
+PAGINATED_FETCH_LIMIT = 100
+#: Maximum number of comments per page a client may request from the
+#: paginated fetch API.
+PAGINATED_FETCH_MAX_LIMIT = 1000
+
+#: Maximum total size in bytes of the in-process cache of encoded thread
+#: responses. Set to 0 to disable the cache. Each process has its own cache,
+#: so `INVALIDATION_BUS_ENABLED` must be set if there are several processes.
+THREAD_CACHE_MAX_BYTES = 0
+#: Maximum total size in bytes of the in-process cache of encoded comments.
+#: Set to 0 to disable the cache. When a thread is fetched, only the comments
+#: which have changed since they were cached are serialized and encoded. The
+#: cache is keyed by the version of each comment row, so it needs no
+#: invalidation.
+COMMENT_FRAGMENT_CACHE_MAX_BYTES = 0
+
+#: Maximum number of identities in the in-process cache of identities, which
+#: saves fetching the identity of a session on each request. Set to 0 to
+#: disable the cache. As for the thread cache, `INVALIDATION_BUS_ENABLED` must
+#: be set if there are several processes.
+IDENTITY_CACHE_MAX_ENTRIES = 0
+#: Seconds for which an identity is cached, which bounds how long a stale
+#: identity may be used if an invalidation is missed.
+IDENTITY_CACHE_TTL = 300
+
+#: Broadcast changes to the in-process caches of all worker processes, using
+#: Postgres `LISTEN/NOTIFY`. Each worker holds one extra database connection
+#: to listen for changes.
+INVALIDATION_BUS_ENABLED = False
+#: Postgres notification channel of the invalidation bus.
+INVALIDATION_CHANNEL = 'pg_discuss_invalidation'
+#: Seconds to wait before reconnecting the invalidation listener.
+INVALIDATION_RECONNECT_DELAY = 1.0
+
 # Session settings
 #: Expiration of a permanent sesison in seconds.
 PERMANENT_SESSION_LIFETIME = 3600
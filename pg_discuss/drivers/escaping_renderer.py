@@ -13,3 +13,15 @@ class EscapingRenderer(ext.CommentRenderer):
         """Render to HMTL entity-encoded text.
         """
         return markupsafe.escape(text)
+
+    def render_many(self, texts, **extras):
+        """Render a sequence of texts to HTML entity-encoded text, with a
+        single call to the escaping function.
+
+        The texts are joined with a NUL character, which Postgres does not
+        allow in text values, and split again once escaped.
+        """
+        texts = list(texts)
+        if not texts:
+            return []
+        return markupsafe.escape(u'\x00'.join(texts)).split(u'\x00')
@@ -51,7 +51,9 @@ class IdentityPolicy(GenericExtBase):
 
     @abc.abstractmethod
     def get_identity(self, request, **extras):
-        """Get the identity record associated with the request.
+        """Get the identity record associated with the request. May return
+        a :class:`pg_discuss.identity.LazyIdentity` to defer fetching or
+        creating the identity until it is used.
         """
 
     @abc.abstractmethod
@@ -75,6 +77,27 @@ class CommentRenderer(GenericExtBase):
         """Render raw text into another format for display.
         """
 
+    def render_many(self, texts, **extras):
+        """Render a sequence of raw texts, returning the list of rendered
+        texts in the same order.
+
+        Called once for all the comments of a thread that need rendering.
+        Renderers may override this to amortize work across the texts.
+        """
+        return [self.render(text) for text in texts]
+
+    def render_key(self, **extras):
+        """Return a string identifying the renderer and any configuration
+        which affects its output.
+
+        Comment text is rendered when it is written, and stored along with
+        this key. Stored text with a different key is considered stale, and
+        is rendered again when read. Renderers with configurable output
+        should include their configuration in the key.
+        """
+        cls = type(self)
+        return '{0}.{1}'.format(cls.__module__, cls.__name__)
+
 
 # Extension ABCs
 @six.add_metaclass(abc.ABCMeta)
@@ -164,20 +187,84 @@ class AddCommentFilterPredicate(GenericExtBase):
     hook_method = add_comment_filter_predicate.__name__
 
 
+@six.add_metaclass(abc.ABCMeta)
+class OnPreThreadFetch(GenericExtBase):
+    """Mixin class for extensions that set options for fetching the comment
+    collection of a thread.
+    """
+    @abc.abstractmethod
+    def on_pre_thread_fetch(self, fetch_options, **extras):
+        """Set options in the `fetch_options` dictionary, which is shared by
+        all extensions. The options are:
+
+         - `reply_limit` and `depth_limit`: fetch only the pruned comment
+           tree with
+           :func:`pg_discuss.queries.fetch_thread_tree_by_client_id`.
+         - `parent_id` and `after`: root the pruned tree at the replies to
+           this comment, and at the comments created after this datetime.
+           Other extensions may also add `predicates` to fetch only the
+           subtree of `parent_id`.
+         - `predicates`: the list of additional predicates on the comment
+           table, for either query.
+         - `order_by`: the ordering to fetch the comment collection with
+           :func:`pg_discuss.queries.fetch_thread_with_comments_by_client_id`.
+        """
+    hook_method = on_pre_thread_fetch.__name__
+
+
 @six.add_metaclass(abc.ABCMeta)
 class OnPreCommentSerialize(GenericExtBase):
     """Mixin class for extensions that want to add fields to the serialized
     comment.
     """
+    #: Map of the names of the fields the hook sets on the client comment to
+    #: their types, or tuples of types, as for `isinstance`. String fields
+    #: are escaped. If None, the types are unknown, and every field of every
+    #: comment is checked for strings to escape.
+    serialized_fields = None
+
     @abc.abstractmethod
     def on_pre_comment_serialize(self, raw_comment, client_comment, **extras):
         """Add fields to the comment representation to be serialized,
         `client_comment`, from the dictionary representing the raw database
         row, `raw_comment`.
+
+        The hook is called for every comment of a thread, so it should
+        declare the fields it sets with `serialized_fields`. Extensions which
+        process many comments should implement
+        :class:`OnPreCommentsSerialize` instead.
+
+        The fields must only depend on `raw_comment`, since serialized
+        comments are cached until their row is updated if
+        `COMMENT_FRAGMENT_CACHE_MAX_BYTES` is set.
         """
     hook_method = on_pre_comment_serialize.__name__
 
 
+@six.add_metaclass(abc.ABCMeta)
+class OnPreCommentsSerialize(GenericExtBase):
+    """Mixin class for extensions that want to add fields to a batch of
+    serialized comments in one call, which avoids the overhead of calling a
+    hook for every comment.
+
+    If an extension implements both this and :class:`OnPreCommentSerialize`,
+    only this hook is called.
+    """
+    #: As for :attr:`OnPreCommentSerialize.serialized_fields`.
+    serialized_fields = None
+
+    @abc.abstractmethod
+    def on_pre_comments_serialize(self, raw_comments, client_comments,
+                                  **extras):
+        """Add fields to each of the comment representations to be
+        serialized, `client_comments`, from the corresponding dictionary
+        representing the raw database row in the list `raw_comments`.
+
+        Single comments are passed as lists of one comment.
+        """
+    hook_method = on_pre_comments_serialize.__name__
+
+
 @six.add_metaclass(abc.ABCMeta)
 class OnPreThreadSerialize(GenericExtBase):
     """Mixin class for extensions that want to add fields to the serialized
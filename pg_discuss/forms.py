@@ -7,21 +7,10 @@ from voluptuous import (
     Required,
     All,
     Any,
-    Invalid,
 )
 
 from . import _compat
 from . import ext
-from . import queries
-
-
-def validate_parent(parent_id):
-    """Validate that the parent_id associated with a new comment corresponds to
-    a valid parent comment.
-    """
-    if parent_id is not None and not queries.validate_parent_exists(parent_id):
-        raise Invalid('parent does not exist')
-    return parent_id
 
 
 def exec_comment_validators(action):
@@ -51,13 +40,17 @@ def exec_comment_validators(action):
 
 
 def validate_new_comment(new_comment):
-    """Validate a new comment."""
+    """Validate a new comment. The `identity_id` is set by the view once the
+    comment is valid, so is optional.
+    """
     new_comment_schema = All(
         Schema({
-            'parent_id': All(Any(int, None), validate_parent),
+            # The existence of the parent is checked when the comment is
+            # inserted. See `queries.insert_comment`.
+            'parent_id': Any(int, None),
             Required('text'): _compat.text_type,
             Required('custom_json'): dict,
-            Required('identity_id'): Any(int, None),
+            'identity_id': Any(int, None),
         }),
         exec_comment_validators(action='create'),
     )
@@ -1,7 +1,12 @@
 """Middleware to execute the configured `IdentityPolicy`.
 """
+import copy
+
 import flask
 
+from . import _compat
+from . import queries
+
 
 class IdentityPolicyManager(object):
     """Middleware to execute the configured IdentityPolicy.
@@ -12,6 +17,10 @@ class IdentityPolicyManager(object):
     `remember` method of the `IdentityPolicy` method is invoked with the
     identity. If no identity is returned by the `IdentityPolicy`, request
     processing continues normally without the identity.
+
+    If the `IdentityPolicy` returns a :class:`LazyIdentity`, the identity is
+    only remembered once it is loaded, so that requests which never use the
+    identity neither load it nor write to the session.
     """
 
     def __init__(self, app, identity_policy_cls):
@@ -53,8 +62,14 @@ class IdentityPolicyManager(object):
             # Store the identity object on the `g` request global.
             flask.g.identity = identity
 
-            # Remember the identity.
-            self.identity_policy.remember(flask.request, identity['id'])
+            # Remember the identity, once it is loaded if it is lazy.
+            if isinstance(identity, LazyIdentity):
+                identity.on_load(self._remember)
+            else:
+                self._remember(identity)
+
+    def _remember(self, identity):
+        self.identity_policy.remember(flask.request, identity['id'])
 
     def exempt(self, view):
         """Exclude a view from the IdentityPolicy middleware. Takes a view
@@ -62,3 +77,99 @@ class IdentityPolicyManager(object):
         """
         view_location = '%s.%s' % (view.__module__, view.__name__)
         self._exempt_views.append(view_location)
+
+
+def fetch_identity(identity_id):
+    """Fetch an identity object by id, from the identity cache of the current
+    app if possible. See :func:`pg_discuss.queries.fetch_identity`.
+
+    Cached identities are invalidated by `identity` events, which are
+    published by :func:`pg_discuss.queries.update_identity`. Each call returns
+    a copy, which may be modified by the caller.
+    """
+    identity_cache = flask.current_app.identity_cache
+    identity = identity_cache.get(identity_id)
+    if identity is None:
+        generation = identity_cache.generation
+        identity = queries.fetch_identity(identity_id)
+        identity_cache.set(identity_id, identity, generation=generation)
+    return copy.deepcopy(identity)
+
+
+class LazyIdentity(_compat.Mapping):
+    """Read-only proxy of an identity object, which is only loaded when one of
+    its fields is first accessed.
+
+    `load` is called with no arguments to fetch or create the identity
+    object. Most requests, such as fetching threads, never use the identity,
+    so an `IdentityPolicy` may return a lazy identity to avoid fetching an
+    identity, or inserting a new identity for anonymous traffic, on every
+    request. Set `new` if loading the identity creates it.
+    """
+
+    def __init__(self, load, new=False):
+        self._load = load
+        self._identity = None
+        self._callbacks = []
+        self.new = new
+
+    @property
+    def loaded(self):
+        return self._identity is not None
+
+    def materialize(self):
+        """Load the identity object, if it is not yet loaded, and return it.
+        Callbacks registered with :meth:`on_load` are called with the identity
+        object the first time it is loaded.
+        """
+        if self._identity is None:
+            self._identity = self._load()
+            callbacks, self._callbacks = self._callbacks, []
+            for callback in callbacks:
+                callback(self._identity)
+        return self._identity
+
+    def on_load(self, callback):
+        """Call `callback` with the identity object once it is loaded."""
+        if self._identity is None:
+            self._callbacks.append(callback)
+        else:
+            callback(self._identity)
+
+    def __getitem__(self, key):
+        return self.materialize()[key]
+
+    def __iter__(self):
+        return iter(self.materialize())
+
+    def __len__(self):
+        return len(self.materialize())
+
+    def __bool__(self):
+        # An identity exists, or will be created, whether or not it is loaded.
+        return True
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        if self._identity is None:
+            return '<LazyIdentity (not loaded)>'
+        return '<LazyIdentity {0!r}>'.format(self._identity)
+
+
+def is_owner(comment):
+    """Check if the identity of the current request owns `comment`.
+
+    A new identity which has not been created yet cannot own any comment, so
+    is not created to be compared.
+    """
+    identity = getattr(flask.g, 'identity', None)
+    if identity is None:
+        return False
+    if (
+        isinstance(identity, LazyIdentity)
+        and identity.new
+        and not identity.loaded
+    ):
+        return False
+    return comment['identity_id'] == identity['id']
@@ -0,0 +1,199 @@
+"""Invalidation bus for in-process caches, built on Postgres `LISTEN/NOTIFY`.
+
+Write paths publish change events, such as `('thread', thread_id)`, and
+in-process caches subscribe to the kinds of events they depend on. Events are
+delivered to the local subscribers immediately, and, if the bus is enabled
+with `INVALIDATION_BUS_ENABLED`, broadcast with `NOTIFY` to every other
+worker process. Each worker runs a background thread that `LISTEN`s on the
+channel and delivers the events to its own subscribers.
+
+Notifications sent while a listener is disconnected are lost, so each
+subscriber also gives a reset callback, which is called to discard everything
+whenever the listener (re)connects.
+"""
+import collections
+import json
+import select
+import threading
+import time
+import uuid
+
+import flask
+import sqlalchemy as sa
+
+from . import ext
+from .db import db
+
+#: Seconds to wait for a notification before checking the connection.
+POLL_TIMEOUT = 5.0
+
+
+class InvalidationBus(object):
+    """Publish change events to subscribers in all worker processes.
+
+    `channel` is the Postgres notification channel. If `enabled` is false,
+    events are only delivered to subscribers in the current process.
+    """
+
+    def __init__(self, channel, enabled, logger, reconnect_delay):
+        self.channel = channel
+        self.enabled = enabled
+        self.logger = logger
+        self.reconnect_delay = reconnect_delay
+        # Identifies events published by this process, which have already
+        # been delivered locally when they arrive from the listener.
+        self.origin = uuid.uuid4().hex
+        # Map of event kind to list of callbacks, called with the event key.
+        self._subscribers = collections.defaultdict(list)
+        # List of callbacks to discard everything, for when events may have
+        # been missed.
+        self._resets = []
+        self._listener = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, kind, callback, reset):
+        """Call `callback` with the key of each event of the given `kind`, and
+        `reset` with no arguments whenever events may have been missed.
+        """
+        self._subscribers[kind].append(callback)
+        self._resets.append(reset)
+
+    def publish(self, *events):
+        """Publish `(kind, key)` events, delivering them to local subscribers
+        at once, and to other processes with a single `NOTIFY`. Keys must be
+        JSON serializable.
+
+        Events should be published after the change has been committed, so
+        that other processes do not reload stale data.
+        """
+        if not events:
+            return
+        self.deliver(events)
+        if self.enabled:
+            payload = json.dumps({'origin': self.origin, 'events': events})
+            db.engine.execute(
+                sa.select([sa.func.pg_notify(self.channel, payload)]))
+
+    def deliver(self, events):
+        """Deliver `(kind, key)` events to local subscribers."""
+        for kind, key in events:
+            for callback in self._subscribers.get(kind, ()):
+                callback(key)
+
+    def reset(self):
+        """Discard everything from all local subscribers."""
+        for reset in self._resets:
+            reset()
+
+    def start(self, engine):
+        """Start the listener thread, if the bus is enabled and the thread is
+        not already running.
+
+        This must be called after the worker process has been forked, since
+        threads do not survive a fork.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._listener is not None and self._listener.is_alive():
+                return
+            self._listener = threading.Thread(
+                target=self._listen,
+                args=(engine,),
+                name='pg-discuss-invalidation-listener',
+            )
+            self._listener.daemon = True
+            self._listener.start()
+
+    def _listen(self, engine):
+        """Listen for notifications forever, reconnecting on failure."""
+        while True:
+            try:
+                self._listen_once(engine)
+            except Exception:
+                self.logger.exception(
+                    'Invalidation listener failed, reconnecting in %ss',
+                    self.reconnect_delay)
+            time.sleep(self.reconnect_delay)
+
+    def _listen_once(self, engine):
+        # Use a dedicated connection, detached from the pool, since it is
+        # held for the lifetime of the process.
+        conn = engine.raw_connection()
+        conn.detach()
+        try:
+            dbapi_conn = conn.connection
+            dbapi_conn.autocommit = True
+            cursor = dbapi_conn.cursor()
+            cursor.execute('LISTEN "{0}"'.format(self.channel))
+            # Notifications may have been missed while disconnected.
+            self.reset()
+            while True:
+                if select.select([dbapi_conn], [], [], POLL_TIMEOUT)[0]:
+                    dbapi_conn.poll()
+                else:
+                    # Detect a dead connection while idle.
+                    cursor.execute('SELECT 1')
+                while dbapi_conn.notifies:
+                    notify = dbapi_conn.notifies.pop(0)
+                    self._on_notify(notify.payload)
+        finally:
+            conn.close()
+
+    def _on_notify(self, payload):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            self.logger.error('Invalid invalidation payload: %r', payload)
+            return
+        if message.get('origin') == self.origin:
+            return
+        self.deliver(message['events'])
+
+
+class CommentChangePublisher(ext.OnPostCommentInsert,
+                             ext.OnPostCommentUpdate):
+    """Hooks to publish `comment` and `thread` events when comments are
+    inserted or updated.
+
+    This is installed by the core, rather than being a configurable extension.
+    Comments written outside of :func:`pg_discuss.queries.insert_comment` and
+    :func:`pg_discuss.queries.update_comment` must be published explicitly.
+    """
+
+    def on_post_comment_insert(self, new_comment, **extras):
+        publish(*comment_events(new_comment))
+
+    def on_post_comment_update(self, old_comment, new_comment, **extras):
+        publish(*comment_events(new_comment))
+
+
+def comment_events(comment):
+    """Get the events for a change to the comment."""
+    return [('comment', comment['id']), ('thread', comment['thread_id'])]
+
+
+def publish(*events):
+    """Publish `(kind, key)` events on the bus of the current app."""
+    flask.current_app.invalidation_bus.publish(*events)
+
+
+def init_app(app):
+    """Create the invalidation bus of the app, install the hooks to publish
+    comment changes, following any extension hooks, and start the listener
+    thread before the first request of each worker process.
+    """
+    app.invalidation_bus = InvalidationBus(
+        app.config['INVALIDATION_CHANNEL'],
+        app.config['INVALIDATION_BUS_ENABLED'],
+        app.logger,
+        app.config['INVALIDATION_RECONNECT_DELAY'],
+    )
+
+    publisher = CommentChangePublisher()
+    app.hook_map[ext.OnPostCommentInsert].append(publisher)
+    app.hook_map[ext.OnPostCommentUpdate].append(publisher)
+
+    @app.before_first_request
+    def start_invalidation_listener():
+        app.invalidation_bus.start(db.engine)
@@ -1,7 +1,13 @@
+import logging
+
 from pg_discuss.app import app_factory
 
 app = app_factory()
 
 
 def execute_from_command_line():
+    # Log the progress of commands at the configured level.
+    if not app.debug:
+        app.logger.addHandler(logging.StreamHandler())
+        app.logger.setLevel(app.config['LOGLEVEL'])
     app.script_manager.run()
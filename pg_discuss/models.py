@@ -7,6 +7,9 @@ Thread schema:
 
  - id: Primary key.
  - client_id: String used as unique identifier by client.
+ - version: Counter incremented whenever a comment in the thread is inserted
+   or updated. Used to answer conditional requests for the thread.
+ - comment_count: Count of the thread's shown comments.
  - custom_json
 
 `client_id` must have a value which is *immutable*.  Client uses this to
@@ -31,8 +34,20 @@ Comment schema:
  - created: Creation timestamp.
  - modified: Modified timestamp.
  - text: The comment text itself.
+ - rendered_text: The comment text as rendered by the `CommentRenderer` when
+   the comment was written.
+ - rendered_key: Key identifying the renderer and configuration used to
+   produce `rendered_text`.
+ - reply_count: Count of the comment's shown descendants.
  - custom_json
 
+Comments are visible if they pass the predicates of all
+`AddCommentFilterPredicate` extensions, and are shown if they and all of
+their ancestors are visible. A comment below a hidden reply is not counted,
+since a client which builds the tree of visible comments never shows it. The
+counts of shown comments are maintained by :mod:`pg_discuss.queries` as
+comments are written, and may be recomputed with `pgd-admin recount_replies`.
+
 custom_json is intended for custom attributes. As a JSON blob, the schema is
 flexible and can be extended without requiring database migrations or changes
 to the core code. Some possible uses:
@@ -48,6 +63,7 @@ from sqlalchemy import (
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     String,
     text,
@@ -73,6 +89,14 @@ class Thread(db.Model):
         DateTime(timezone=True),
         server_default=text('NOW()'),
         nullable=False)
+    version = Column(
+        Integer,
+        server_default='0',
+        nullable=False)
+    comment_count = Column(
+        Integer,
+        server_default='0',
+        nullable=False)
     custom_json = Column(
         JSONB,
         server_default='{}',
@@ -115,6 +139,16 @@ class Comment(db.Model):
     text = Column(
         String,
         nullable=False)
+    rendered_text = Column(
+        String,
+        nullable=True)
+    rendered_key = Column(
+        String,
+        nullable=True)
+    reply_count = Column(
+        Integer,
+        server_default='0',
+        nullable=False)
     custom_json = Column(
         JSONB,
         server_default='{}',
@@ -126,6 +160,13 @@ class Comment(db.Model):
         'Thread',
         backref=backref('comments', cascade='all, delete-orphan'))
 
+    __table_args__ = (
+        # Index for fetching a thread's comments in chronological order,
+        # and for keyset pagination on `(created, id)`.
+        Index('ix_comment_thread_id_created_id',
+              'thread_id', 'created', 'id'),
+    )
+
     def __unicode__(self):
         return '<{}> {}'.format(self.identity, self.text[:40])
     __str__ = __unicode__
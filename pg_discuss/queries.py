@@ -1,12 +1,28 @@
 """Queries used by pg-discuss core and available to extensions."""
+import re
+
+import flask
 import sqlalchemy as sa
 import sqlalchemy.dialects.postgresql
+import sqlalchemy.sql.visitors
 
 from . import ext
+from . import invalidation
+from . import records
 from . import tables
 from . import utils
+from . import _compat
 from .db import db
 
+#: Prefix used to label thread columns when selected alongside comments.
+THREAD_COL_PREFIX = 'thread__'
+
+#: Comment columns which are selected as Unix timestamps, if requested.
+EPOCH_TIME_COLUMNS = ('created', 'modified')
+
+# Parameter placeholders of statements compiled for `cte_chain`.
+BIND_PARAM_RE = re.compile(r'%\((\w+)\)s')
+
 
 class CommentNotFoundError(Exception):
     pass
@@ -55,11 +71,38 @@ def fetch_comment_by_id(comment_id):
 
 def fetch_comments_by_thread_client_id(thread_client_id):
     """Fetch a list of comments for the given thread's client_id from the
-    database."""
+    database, ordered by `created`.
+
+    See :func:`fetch_thread_with_comments_by_client_id`, which also fetches
+    the thread in the same round trip.
+    """
+    thread, comments_seq = fetch_thread_with_comments_by_client_id(
+        thread_client_id)
+    return comments_seq
+
+
+def iter_comments_by_thread_client_id(thread_client_id, batch_size=None,
+                                      epoch_times=False):
+    """Iterate over the comments for the given thread's client_id, ordered by
+    `created`, without loading them all into memory at once.
+
+    Rows are read from a server-side cursor in batches of `batch_size`, which
+    defaults to the `COMMENT_STREAM_BATCH_SIZE` setting. The cursor requires
+    a transaction, so a connection is held from the pool until the iterator
+    is exhausted or closed.
+
+    The statement is built when this function is called, so the iterator may
+    be consumed outside of the app context. See :func:`epoch_time_columns`
+    for `epoch_times`. Each comment has a `row_version`, see
+    :func:`row_version`.
+    """
+    if batch_size is None:
+        batch_size = flask.current_app.config['COMMENT_STREAM_BATCH_SIZE']
     t_comment = tables.comment
     t_thread = tables.thread
     stmt = (
-        sa.select(t_comment.c)
+        sa.select(epoch_time_columns(t_comment.c, epoch_times)
+                  + [row_version(t_comment)])
         .select_from(sa.join(t_comment, t_thread))
         .where(t_thread.c.client_id == thread_client_id)
         .order_by(sa.asc(t_comment.c.created))
@@ -68,37 +111,374 @@ def fetch_comments_by_thread_client_id(thread_client_id):
     # Run add_comment_filter_predicate hooks
     stmt = ext.exec_filter_hooks(ext.AddCommentFilterPredicate, stmt)
 
+    return _iter_rows(stmt, batch_size)
+
+
+def epoch_time_columns(columns, epoch_times):
+    """Get the list of `columns` to select. If `epoch_times` is True, the
+    timestamp columns in `EPOCH_TIME_COLUMNS` are selected as Unix timestamps
+    (floating point seconds), under the same names.
+
+    Encoding timestamps computed in the database avoids a call to the `default`
+    method of the JSON encoder for each datetime. See
+    :func:`pg_discuss.serialize.wants_epoch_times`.
+    """
+    if not epoch_times:
+        return list(columns)
+    return [
+        sa.cast(sa.extract('epoch', c), sa.Float).label(c.name)
+        if c.name in EPOCH_TIME_COLUMNS else c
+        for c in columns
+    ]
+
+
+def row_version(table):
+    """Get the Postgres `xmin` system column of `table`, as text labeled
+    `row_version`.
+
+    The version of a row changes whenever it is updated, including updates
+    which do not set `modified`, such as of vote and reply counts. See
+    :class:`pg_discuss.serialize.CommentSerializer`.
+    """
+    return sa.cast(
+        sa.literal_column(table.name + '.xmin'), sa.Text
+    ).label('row_version')
+
+
+def _iter_rows(stmt, batch_size):
+    conn = db.engine.connect().execution_options(
+        isolation_level='READ COMMITTED',
+        stream_results=True,
+    )
+    try:
+        with conn.begin():
+            result = conn.execute(stmt)
+            columns = records.Columns(result.keys())
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield records.Record(columns, row)
+            result.close()
+    finally:
+        conn.close()
+
+
+def fetch_thread_with_comments_by_client_id(thread_client_id, predicates=(),
+                                            order_by=None, epoch_times=False,
+                                            limit=None):
+    """Fetch a thread object and the list of its comments for the given
+    thread's client_id from the database, in a single round trip.
+
+    The thread is outer-joined to its comments, so that a thread without
+    any comments is still returned. For the same reason, the predicates from
+    `AddCommentFilterPredicate` hooks, and any additional `predicates` on the
+    comment table, are applied to the join condition rather than the WHERE
+    clause.
+
+    Comments are ordered by `created`, unless another `order_by` expression
+    is given. If `limit` is given, at most that many comments are fetched.
+    See :func:`epoch_time_columns` for `epoch_times`. Each comment has a
+    `row_version`, see :func:`row_version`.
+
+    Returns a tuple of `(thread, comments_seq)`. If the thread does not exist,
+    `thread` is None and `comments_seq` is empty.
+    """
+    t_comment = tables.comment
+    t_thread = tables.thread
+
+    # Label the thread columns to avoid name collisions with the comment
+    # columns (eg, `id`, `created`, `custom_json`).
+    thread_cols = [c.label(THREAD_COL_PREFIX + c.name) for c in t_thread.c]
+
+    # Run add_comment_filter_predicate hooks
+    predicates = (
+        ext.exec_hooks(ext.AddCommentFilterPredicate) + list(predicates))
+    join_cond = sa.and_(t_comment.c.thread_id == t_thread.c.id, *predicates)
+
+    if order_by is None:
+        order_by = sa.asc(t_comment.c.created)
+    stmt = (
+        sa.select(thread_cols
+                  + epoch_time_columns(t_comment.c, epoch_times)
+                  + [row_version(t_comment)])
+        .select_from(sa.outerjoin(t_thread, t_comment, join_cond))
+        .where(t_thread.c.client_id == thread_client_id)
+        .order_by(order_by)
+        .limit(limit)
+    )
+
     result = db.engine.execute(stmt)
     # Very large result sets can cause a lot of memory allocation here
     # that CPython may not give back to the OS, due to a lack of compacting
     # GC. See: http://stackoverflow.com/a/5495318
     # However, assuming a worst case of 50K smallish rows, the memory for the
     # process will only roughly double (to about 100MB).
-    # If comments could be sorted in the database, it would not be necessary
-    # to fetch all the results and sort in-process. This has the drawback
-    # of putting more load on the database server. If memory due to large
-    # allocations for results is an issue, it is recommended to reload
-    # workers after exceeding a memory limit via uwsgi's `reload-on-rss`.
-    comments_seq = [dict(x) for x in result.fetchall()]
+    # If memory due to large allocations for results is an issue, it is
+    # recommended to reload workers after exceeding a memory limit via uwsgi's
+    # `reload-on-rss`. Compact records are used rather than dicts to reduce
+    # the allocations, and large threads may be streamed instead, see
+    # :func:`iter_comments_by_thread_client_id`.
+    rows = result.fetchall()
     result.close()
 
-    return comments_seq
+    if not rows:
+        return None, []
+
+    thread_keys = [c.name for c in t_thread.c]
+    comment_keys = [c.name for c in t_comment.c] + ['row_version']
+    num_thread_cols = len(thread_keys)
+
+    thread = dict(zip(thread_keys, tuple(rows[0])[:num_thread_cols]))
+    comments_seq = records.Record.from_rows(
+        comment_keys, (tuple(x)[num_thread_cols:] for x in rows))
+    # A thread without comments yields a single row of NULL comment columns.
+    if comments_seq[0]['id'] is None:
+        comments_seq = []
+
+    return thread, comments_seq
+
+
+def fetch_thread_tree_by_client_id(thread_client_id, reply_limit=None,
+                                   depth_limit=None, parent_id=None,
+                                   after=None, predicates=(),
+                                   epoch_times=False):
+    """Fetch a thread object and the pruned tree of its comments for the given
+    thread's client_id from the database, in a single round trip.
+
+    The tree is rooted at the top-level comments, or, if `parent_id` is
+    given, at the replies to that comment. If `after` is given, only the
+    roots created after that datetime, and their replies, are fetched.
+
+    Only the first `reply_limit` replies to each comment (and the first
+    `reply_limit` roots) are fetched, ordered by `created` and `id`. Roots
+    have a depth of 1, and replies at a depth greater than `depth_limit + 1`
+    are not fetched. Either limit may be None. Any additional `predicates` on
+    the comment table are applied along with the predicates from
+    `AddCommentFilterPredicate` hooks; for example, to restrict the comments
+    to the subtree of `parent_id` with an index.
+
+    The tree is pruned in the database with a recursive CTE, so that only the
+    comments that will be shown are transferred. The counts needed to tell
+    the client what was pruned are derived from the stored counts of visible
+    comments, and returned on the thread:
+
+     - `reply_count`: the total number of comments under the roots, which is
+       the number of comments in the thread if neither `parent_id` nor
+       `after` is given.
+     - `comment_annotations`: a map of comment id to a dictionary with the
+       comment's `depth`, its `reply_count` of all descendants, and its
+       `after_count` of all later siblings and their descendants.
+
+    See :func:`epoch_time_columns` for `epoch_times`. Each comment has a
+    `row_version`, see :func:`row_version`.
+
+    Returns a tuple of `(thread, comments_seq)`, with comments ordered by
+    `created` and `id`. If the thread does not exist, `thread` is None and
+    `comments_seq` is empty.
+    """
+    t_comment = tables.comment
+    t_thread = tables.thread
 
+    # Comments of the thread which pass the filter predicates. Replies are
+    # created after their parents, so if only the roots created after `after`
+    # are fetched, all of the comments in the tree, and all of their siblings,
+    # are also created after `after`. Filtering them here allows a range scan
+    # on the `(thread_id, created, id)` index, and leaves the counts
+    # unchanged.
+    predicates = (
+        ext.exec_hooks(ext.AddCommentFilterPredicate) + list(predicates))
+    if after is not None:
+        predicates.append(t_comment.c.created > after)
+    visible = (
+        sa.select(list(t_comment.c) + [row_version(t_comment)])
+        .select_from(sa.join(t_comment, t_thread))
+        .where(t_thread.c.client_id == thread_client_id)
+        .where(sa.and_(*predicates))
+        .cte('visible')
+    )
 
-def insert_comment(new_comment):
-    """Insert the `new_comment` object in to the database."""
-    t = tables.comment
+    # Rank each comment among its siblings, and count the later siblings and
+    # their descendants as the total for all siblings less the running total.
+    reply_count = visible.c.reply_count
+    siblings = dict(partition_by=visible.c.parent_id)
+    preceding = dict(siblings, order_by=[visible.c.created, visible.c.id])
+    ranked = (
+        sa.select(list(visible.c) + [
+            sa.func.row_number().over(**preceding).label('sibling_index'),
+            sa.cast(
+                sa.func.sum(reply_count + 1).over(**siblings)
+                - sa.func.sum(reply_count + 1).over(**preceding),
+                sa.Integer
+            ).label('after_count'),
+        ])
+        .cte('ranked')
+    )
+
+    # Descend from the first `reply_limit` roots, keeping only the first
+    # `reply_limit` replies of each comment, up to the depth limit. Comparing
+    # to a `parent_id` of None selects the top-level comments.
+    depth = sa.literal_column('1', sa.Integer).label('depth')
+    anchor = (
+        sa.select(list(ranked.c) + [depth])
+        .where(ranked.c.parent_id == parent_id)
+    )
+    if reply_limit is not None:
+        anchor = anchor.where(ranked.c.sibling_index <= reply_limit)
+    tree = anchor.cte('tree', recursive=True)
+    reply = ranked.alias('reply')
+    step = (
+        sa.select(list(reply.c) + [tree.c.depth + 1])
+        .where(reply.c.parent_id == tree.c.id)
+    )
+    if reply_limit is not None:
+        step = step.where(reply.c.sibling_index <= reply_limit)
+    if depth_limit is not None:
+        step = step.where(tree.c.depth <= depth_limit)
+    tree = tree.union_all(step)
+
+    # Outer-join the thread to the tree, so that a thread without any
+    # comments is still returned.
+    thread_cols = [c.label(THREAD_COL_PREFIX + c.name) for c in t_thread.c]
     stmt = (
-        t.insert()
-        .values(**new_comment)
-        .returning(*list(t.c))
+        sa.select(thread_cols + epoch_time_columns(tree.c, epoch_times))
+        .select_from(sa.outerjoin(t_thread, tree, sa.true()))
+        .where(t_thread.c.client_id == thread_client_id)
+        .order_by(sa.asc(tree.c.created), sa.asc(tree.c.id))
     )
 
+    result = db.engine.execute(stmt)
+    rows = result.fetchall()
+    result.close()
+
+    if not rows:
+        return None, []
+
+    thread = {c.name: rows[0][THREAD_COL_PREFIX + c.name] for c in t_thread.c}
+    if parent_id is None and after is None:
+        thread['reply_count'] = thread['comment_count']
+    else:
+        # The first root counts itself, its replies, and all later roots.
+        first_root = next((r for r in rows if r['depth'] == 1), None)
+        thread['reply_count'] = (
+            first_root['reply_count'] + 1 + first_root['after_count']
+            if first_root is not None else 0
+        )
+
+    comment_keys = [c.name for c in t_comment.c] + ['row_version']
+    annotation_keys = ['reply_count', 'after_count', 'depth']
+    comment_columns = records.Columns(comment_keys)
+    annotation_columns = records.Columns(annotation_keys)
+    comments_seq = []
+    comment_annotations = {}
+    for row in rows:
+        # A thread without comments yields a single row of NULL columns.
+        if row['id'] is None:
+            continue
+        comments_seq.append(records.Record(
+            comment_columns, [row[k] for k in comment_keys]))
+        comment_annotations[row['id']] = records.Record(
+            annotation_columns, [row[k] for k in annotation_keys])
+    thread['comment_annotations'] = comment_annotations
+
+    return thread, comments_seq
+
+
+def count_comments_by_thread_client_ids(thread_client_ids):
+    """Count the comments of each of the threads with the given client_ids,
+    in a single query.
+
+    Returns a map of thread client_id to the count of comments which pass the
+    `AddCommentFilterPredicate` predicates. Threads that do not exist, or do
+    not have any such comments, are not included.
+    """
+    if not thread_client_ids:
+        return {}
+    t_comment = tables.comment
+    t_thread = tables.thread
+    stmt = (
+        sa.select([t_thread.c.client_id, sa.func.count()])
+        .select_from(sa.join(t_comment, t_thread))
+        .where(t_thread.c.client_id.in_(thread_client_ids))
+        .group_by(t_thread.c.client_id)
+    )
+
+    # Run add_comment_filter_predicate hooks
+    stmt = ext.exec_filter_hooks(ext.AddCommentFilterPredicate, stmt)
+
+    return dict(db.engine.execute(stmt).fetchall())
+
+
+def fetch_comments_page_by_thread_client_id(thread_client_id, limit,
+                                            after_created=None,
+                                            after_id=None):
+    """Fetch a page of up to `limit` comments for the given thread's client_id
+    from the database, ordered by `created` and `id`.
+
+    Uses keyset pagination: if `after_created` and `after_id` are given, only
+    comments which come after the comment with that `created` timestamp and
+    `id` are fetched. Unlike an offset, this allows each page to be fetched
+    with a range scan on the `(thread_id, created, id)` index.
+    """
+    t_comment = tables.comment
+    t_thread = tables.thread
+    stmt = (
+        sa.select(t_comment.c)
+        .select_from(sa.join(t_comment, t_thread))
+        .where(t_thread.c.client_id == thread_client_id)
+        .order_by(sa.asc(t_comment.c.created), sa.asc(t_comment.c.id))
+        .limit(limit)
+    )
+    if after_created is not None:
+        stmt = stmt.where(
+            sa.tuple_(t_comment.c.created, t_comment.c.id)
+            > sa.tuple_(after_created, after_id)
+        )
+
+    # Run add_comment_filter_predicate hooks
+    stmt = ext.exec_filter_hooks(ext.AddCommentFilterPredicate, stmt)
+
+    result = db.engine.execute(stmt)
+    comments_seq = records.Record.from_rows(result.keys(), result.fetchall())
+    result.close()
+
+    return comments_seq
+
+
+def insert_comment(new_comment, thread_client_id=None):
+    """Insert the `new_comment` object in to the database.
+
+    The comment is inserted in the thread with the id `thread_id` of the
+    comment, or, if `thread_client_id` is given, the thread with that client
+    id, which is created if it does not exist. The comment is inserted, and
+    the thread and the ancestors of the comment are updated, in a single
+    statement. See :func:`comment_insert_chain`.
+
+    Raises `ThreadNotFoundError` if the thread does not exist, and
+    `CommentNotFoundError` if the parent of the comment does not exist.
+    """
     # Run on_pre_insert hooks
     ext.exec_hooks(ext.OnPreCommentInsert, new_comment)
 
-    result = db.engine.execute(stmt).first()
-    comment = dict(result.items())
+    # Store the rendered text along with the comment.
+    values = dict(new_comment, **render_text(new_comment['text']))
+    thread_id = values.pop('thread_id', None)
+    stmt, bindparams = cte_chain(comment_insert_chain(
+        values,
+        thread_id=thread_id,
+        thread_client_id=thread_client_id,
+        predicates=ext.exec_hooks(ext.AddCommentFilterPredicate),
+    ))
+
+    result = db.engine.execute(stmt, **bindparams).first()
+    if not result['parent_exists']:
+        raise CommentNotFoundError(
+            'Parent comment {0} not found'.format(values['parent_id']))
+    if result[THREAD_COL_PREFIX + 'id'] is None:
+        raise ThreadNotFoundError('Thread {0} not found'.format(thread_id))
+
+    comment = {c.name: result[c.name] for c in tables.comment.c}
 
     # Run on_post_insert hooks
     ext.exec_hooks(ext.OnPostCommentInsert, comment)
@@ -106,25 +486,478 @@ def insert_comment(new_comment):
     return comment
 
 
-def insert_thread(new_thread):
-    """Insert the `new_thread` object in to the database."""
+def comment_insert_chain(values, thread_id=None, thread_client_id=None,
+                         predicates=()):
+    """Create the statements to insert a comment with the column `values`,
+    to be chained by :func:`cte_chain`.
+
+    A value may be an SQL expression, such as the next value of a sequence,
+    which is evaluated once. It may also be a callable, which is called with
+    the columns of the row of the other values, and returns the SQL
+    expression of the value. For example, a value may be computed from the
+    `id` of the comment, if the `id` is given as an expression.
+
+    The comment is inserted in the thread with the id `thread_id`, or, if
+    `thread_client_id` is given, the thread with that client id, which is
+    created if it does not exist, with :func:`thread_upsert`. The comment is
+    only inserted if its parent exists. The version of the thread is
+    incremented, and, if the comment passes all `predicates`, it is counted
+    in the thread and its ancestors, as by :func:`reply_count_adjustments`.
+
+    The last statement selects a single row of whether the parent exists, as
+    `parent_exists`, the `id` of the thread, labeled with the
+    `THREAD_COL_PREFIX`, and the columns of the inserted comment. The
+    columns are null if the comment was not inserted.
+    """
+    t_comment = tables.comment
+    t_thread = tables.thread
+
+    # The results of the statements are referred to by their names in the
+    # chain. A row may only be written once by the chain, and the rows
+    # written by one statement are not visible to the others, except through
+    # these results.
+    comment_cols = [sa.column(c.name, c.type) for c in t_comment.c]
+    candidate = sa.table('t0', *comment_cols + [
+        sa.column('parent_exists'), sa.column('ancestors_visible')])
+    thread = sa.table('t1', sa.column('id'))
+    inserted = sa.table(
+        't2', *[sa.column(c.name, c.type) for c in t_comment.c])
+
+    # Select the comment to insert as a row of typed values, with the server
+    # defaults for columns without a value, so that the predicates can be
+    # applied to it before it is inserted.
+    def value(column):
+        v = values.get(column.name)
+        if isinstance(v, sa.sql.ClauseElement):
+            expr = v
+        elif column.name in values and not callable(v):
+            expr = sa.bindparam(column.name, v, type_=column.type)
+        elif column.server_default is not None:
+            expr = column.server_default.arg
+            if isinstance(expr, _compat.string_types):
+                expr = sa.literal(expr)
+        else:
+            expr = sa.null()
+        return sa.cast(expr, column.type).label(column.name)
+
+    # Computed values are selected from the row of the other values.
+    row = sa.select([value(c) for c in t_comment.c]).alias('comment_values')
+
+    def computed_value(column):
+        v = values.get(column.name)
+        if callable(v) and not isinstance(v, sa.sql.ClauseElement):
+            return sa.cast(v(row.c), column.type).label(column.name)
+        return row.c[column.name]
+
+    # The parent must be a comment of the same thread.
+    parent_id = values.get('parent_id')
+    if parent_id is None:
+        parent_exists = sa.true()
+        ancestors_visible = sa.true()
+    else:
+        if thread_client_id is not None:
+            parent_thread_id = (
+                sa.select([t_thread.c.id])
+                .where(t_thread.c.client_id == thread_client_id)
+                .as_scalar()
+            )
+        else:
+            parent_thread_id = thread_id
+        parent_exists = (
+            sa.exists([1])
+            .where(t_comment.c.id == parent_id)
+            .where(t_comment.c.thread_id == parent_thread_id)
+        )
+        ancestors_visible = sa.not_(
+            hidden_ancestor_exists(parent_id, predicates))
+    select_candidate = sa.select(
+        [computed_value(c) for c in t_comment.c]
+        + [parent_exists.label('parent_exists'),
+           ancestors_visible.label('ancestors_visible')])
+
+    # The comment is counted in the thread only if it is shown.
+    visible_count = (
+        sa.select([sa.func.count()])
+        .select_from(candidate)
+        .where(comment_predicates(predicates, candidate))
+        .where(candidate.c.ancestors_visible)
+        .as_scalar()
+    )
+    if thread_client_id is not None:
+        new_thread = sa.select([
+            sa.cast(sa.bindparam('client_id', thread_client_id),
+                    t_thread.c.client_id.type),
+            sa.literal(1),
+            visible_count,
+        ]).where(candidate.c.parent_exists)
+        bump_thread = thread_upsert(
+            new_thread,
+            ['client_id', 'version', 'comment_count'],
+            version=t_thread.c.version + 1,
+            comment_count=lambda excluded: (
+                t_thread.c.comment_count + excluded.comment_count),
+        ).returning(t_thread.c.id)
+    else:
+        bump_thread = (
+            t_thread.update()
+            .where(t_thread.c.id == thread_id)
+            .where(candidate.c.parent_exists)
+            .values(version=t_thread.c.version + 1,
+                    comment_count=t_thread.c.comment_count + visible_count)
+            .returning(t_thread.c.id)
+        )
+
+    names = sorted(values)
+    insert = (
+        t_comment.insert()
+        .from_select(
+            ['thread_id'] + names,
+            sa.select([thread.c.id] + [candidate.c[k] for k in names]),
+        )
+        .returning(*list(t_comment.c))
+    )
+
+    ancestors = visible_ancestors(
+        sa.select([inserted.c.parent_id, inserted.c.thread_id])
+        .where(comment_predicates(predicates, inserted))
+        .alias('counted'),
+        predicates,
+    )
+    update_ancestors = (
+        t_comment.update()
+        .where(t_comment.c.id.in_(sa.select([ancestors.c.id])))
+        .values(reply_count=t_comment.c.reply_count + 1)
+    )
+
+    result = (
+        sa.select([
+            candidate.c.parent_exists,
+            thread.c.id.label(THREAD_COL_PREFIX + 'id'),
+        ] + list(inserted.c))
+        .select_from(
+            candidate
+            .outerjoin(thread, sa.true())
+            .outerjoin(inserted, sa.true())
+        )
+    )
+    return [select_candidate, bump_thread, insert, update_ancestors, result]
+
+
+def thread_version_bump(thread_ids):
+    """Create a statement to increment the `version` of threads.
+
+    The version of a thread must be incremented whenever one of its comments
+    is inserted or updated, since it is used to determine whether a client's
+    cached copy of the thread is still current. `thread_ids` may be a list
+    of ids, or a select statement returning ids.
+    """
     t = tables.thread
-    stmt = (
-        t.insert()
-        .values(**new_thread)
-        .returning(*list(t.c))
+    return (
+        t.update()
+        .where(t.c.id.in_(thread_ids))
+        .values(version=t.c.version + 1)
     )
 
-    # TODO: Run on_pre_thread_insert hooks
-    # ext.exec_hooks(ext.OnPreThreadInsert, new_thread)
 
-    result = db.engine.execute(stmt).first()
-    thread = dict(result.items())
+def comment_predicates(predicates, comment):
+    """Apply `predicates` on the comment table to `comment`, an alias of the
+    comment table or another selectable with the same columns, such as a
+    comment selected from a :func:`cte_chain`. Returns the conjunction of the
+    predicates, which is true if there are none.
+    """
+    t = tables.comment
 
-    # TODO: Run on_post_thread_insert hooks
-    # ext.exec_hooks(ext.OnPostThreadInsert, thread)
+    def replace(element):
+        if isinstance(element, sa.Column) and element.table is t:
+            return comment.c[element.name]
+    return sa.and_(sa.true(), *[
+        sqlalchemy.sql.visitors.replacement_traverse(p, {}, replace)
+        for p in predicates
+    ])
 
-    return thread
+
+def visible_ancestors(comments, predicates):
+    """Create a recursive CTE of the `id` of the ancestors of `comments`, a
+    selectable with the `parent_id` and `thread_id` columns of comments.
+
+    Ancestors are walked up from the parent of each comment through the
+    ancestors which pass all `predicates`, up to and including the first
+    ancestor which does not, since the comment is not shown under it. Only
+    ancestors in the thread of the comment are walked. Each ancestor appears
+    once for each comment.
+    """
+    t = tables.comment
+    ancestors = (
+        sa.select([
+            t.c.id,
+            t.c.parent_id,
+            t.c.thread_id,
+            comment_predicates(predicates, t).label('visible'),
+        ])
+        .select_from(sa.join(t, comments, sa.and_(
+            t.c.id == comments.c.parent_id,
+            t.c.thread_id == comments.c.thread_id,
+        )))
+        .cte('ancestors', recursive=True)
+    )
+    parent = t.alias('parent')
+    # A null predicate hides the ancestor, as in a WHERE clause.
+    return ancestors.union_all(
+        sa.select([
+            parent.c.id,
+            parent.c.parent_id,
+            parent.c.thread_id,
+            comment_predicates(predicates, parent),
+        ])
+        .where(parent.c.id == ancestors.c.parent_id)
+        .where(parent.c.thread_id == ancestors.c.thread_id)
+        .where(ancestors.c.visible)
+    )
+
+
+def hidden_ancestor_exists(comment_id, predicates):
+    """Create a clause of whether the comment with the id `comment_id`, or
+    one of its ancestors, does not pass all `predicates`. `comment_id` may be
+    an SQL expression, and if it is null, the clause is false.
+    """
+    t = tables.comment
+    chain = (
+        sa.select([
+            t.c.parent_id,
+            comment_predicates(predicates, t).label('visible'),
+        ])
+        .where(t.c.id == comment_id)
+        .cte('chain', recursive=True)
+    )
+    parent = t.alias('chain_parent')
+    # Stop at the first hidden comment.
+    chain = chain.union_all(
+        sa.select([
+            parent.c.parent_id,
+            comment_predicates(predicates, parent),
+        ])
+        .where(parent.c.id == chain.c.parent_id)
+        .where(chain.c.visible)
+    )
+    # A comment is hidden if a predicate is false or null.
+    return sa.exists(
+        sa.select([1]).select_from(chain)
+        .where(chain.c.visible.isnot(sa.true())))
+
+
+def descendant_counts(where, predicates=()):
+    """Create a subquery of the id of each ancestor of the comments matching
+    the `where` clause, with the count `n` of those comments which are shown
+    under the ancestor, as by :func:`visible_ancestors`.
+    """
+    t = tables.comment
+    ancestors = visible_ancestors(
+        sa.select([t.c.parent_id, t.c.thread_id])
+        .where(where)
+        .alias('counted'),
+        predicates,
+    )
+    return (
+        sa.select([ancestors.c.id, sa.func.count().label('n')])
+        .group_by(ancestors.c.id)
+        .alias('descendant_counts')
+    )
+
+
+def reply_count_adjustments(comment_id, delta, predicates=()):
+    """Create statements to adjust the counts of visible comments once the
+    comment with the id `comment_id` has been shown, with a `delta` of 1, or
+    hidden, with a `delta` of -1, by a change to whether it passes all
+    `predicates`.
+
+    The comment and its counted replies are added to, or removed from, the
+    `reply_count` of its ancestors, as by :func:`visible_ancestors`, and the
+    `comment_count` of the thread, if all of the ancestors are visible.
+
+    Must be used whenever a comment becomes visible or hidden, so that the
+    counts of visible comments are kept up to date. If several comments are
+    shown or hidden, the adjustments of each must be made before the next
+    comment is changed, since each adjustment depends on the visibility of
+    the ancestors, and the counts of the replies, of the comment.
+    """
+    t_comment = tables.comment
+    t_thread = tables.thread
+    comment = t_comment.alias('shown_or_hidden')
+
+    def scalar(column):
+        return (
+            sa.select([column])
+            .where(comment.c.id == comment_id)
+            .as_scalar()
+        )
+
+    amount = delta * (scalar(comment.c.reply_count) + 1)
+    ancestors = visible_ancestors(
+        sa.select([comment.c.parent_id, comment.c.thread_id])
+        .where(comment.c.id == comment_id)
+        .alias('counted'),
+        predicates,
+    )
+    update_comments = (
+        t_comment.update()
+        .where(t_comment.c.id.in_(sa.select([ancestors.c.id])))
+        .values(reply_count=t_comment.c.reply_count + amount)
+    )
+    update_thread = (
+        t_thread.update()
+        .where(t_thread.c.id == scalar(comment.c.thread_id))
+        .where(sa.not_(hidden_ancestor_exists(
+            scalar(comment.c.parent_id), predicates)))
+        .values(comment_count=t_thread.c.comment_count + amount)
+    )
+    return [update_comments, update_thread]
+
+
+def update_comments_visibility(comment_ids, values):
+    """Update the comments in `comment_ids` with the column `values`, such
+    as a change to their moderation status, which may show or hide them.
+
+    The comments are updated one at a time, and the counts of visible
+    comments are adjusted for each comment which was shown or hidden, as by
+    :func:`reply_count_adjustments`. The version of their threads is
+    incremented, in the same transaction. The comments are locked first, so
+    that concurrent updates of the same comments are counted one after the
+    other.
+
+    Returns the list of `(id, thread_id)` of the updated comments.
+    """
+    t = tables.comment
+    predicates = ext.exec_hooks(ext.AddCommentFilterPredicate)
+    visible = comment_predicates(predicates, t).label('visible')
+
+    with db.engine.begin() as conn:
+        # Lock in order of id, so that concurrent updates do not deadlock.
+        locked = conn.execute(
+            sa.select([t.c.id, visible])
+            .where(t.c.id.in_(comment_ids))
+            .order_by(t.c.id)
+            .with_for_update()
+        ).fetchall()
+
+        result = []
+        for comment_id, was_visible in locked:
+            row = conn.execute(
+                t.update()
+                .where(t.c.id == comment_id)
+                .values(**values)
+                .returning(t.c.id, t.c.thread_id, visible)
+            ).first()
+            result.append((row[0], row[1]))
+            # A comment is hidden if a predicate is false or null.
+            if bool(row[2]) != bool(was_visible):
+                delta = 1 if row[2] else -1
+                for stmt in reply_count_adjustments(
+                        comment_id, delta, predicates):
+                    conn.execute(stmt)
+
+        thread_ids = set(row[1] for row in result)
+        if thread_ids:
+            conn.execute(thread_version_bump(list(thread_ids)))
+
+    return result
+
+
+def reply_recount(thread_ids, predicates=()):
+    """Create statements to recompute the counts of the comments of the
+    threads which pass all `predicates` from scratch, and increment the
+    version of the threads. `thread_ids` may be a list of ids, or a select
+    statement returning ids.
+
+    The statements must be executed in order, in one transaction, since the
+    counts of the threads are computed from the counts of their comments.
+    """
+    t_comment = tables.comment
+    t_thread = tables.thread
+
+    # Set the count of every comment in the threads, including comments
+    # without any visible descendants. Comments with a correct count are not
+    # written.
+    counts = descendant_counts(
+        sa.and_(t_comment.c.thread_id.in_(thread_ids), *predicates),
+        predicates,
+    )
+    c = t_comment.alias('c')
+    new_counts = (
+        sa.select([
+            c.c.id,
+            sa.func.coalesce(counts.c.n, 0).label('n'),
+        ])
+        .select_from(sa.outerjoin(c, counts, c.c.id == counts.c.id))
+        .where(c.c.thread_id.in_(thread_ids))
+        .alias('new_counts')
+    )
+    update_comments = (
+        t_comment.update()
+        .where(t_comment.c.id == new_counts.c.id)
+        .where(t_comment.c.reply_count != new_counts.c.n)
+        .values(reply_count=new_counts.c.n)
+    )
+
+    # The comments shown in a thread are its visible top-level comments and
+    # their counted replies.
+    root = t_comment.alias('root')
+    comment_count = (
+        sa.select([sa.func.coalesce(sa.func.sum(root.c.reply_count + 1), 0)])
+        .where(root.c.thread_id == t_thread.c.id)
+        .where(root.c.parent_id == None)  # noqa
+        .where(comment_predicates(predicates, root))
+        .as_scalar()
+    )
+    update_threads = (
+        t_thread.update()
+        .where(t_thread.c.id.in_(thread_ids))
+        .values(comment_count=comment_count, version=t_thread.c.version + 1)
+    )
+    return [update_comments, update_threads]
+
+
+def recount_replies(thread_ids):
+    """Recompute the counts of visible comments of the threads from scratch,
+    and increment the version of the threads, in one transaction. See
+    :func:`reply_recount`.
+    """
+    predicates = ext.exec_hooks(ext.AddCommentFilterPredicate)
+    with db.engine.begin() as conn:
+        for stmt in reply_recount(thread_ids, predicates):
+            conn.execute(stmt)
+
+
+def fetch_thread_ids(after_id=None, limit=1000):
+    """Fetch up to `limit` thread ids in order, after `after_id` if given."""
+    t = tables.thread
+    stmt = sa.select([t.c.id]).order_by(t.c.id).limit(limit)
+    if after_id is not None:
+        stmt = stmt.where(t.c.id > after_id)
+    return [row[0] for row in db.engine.execute(stmt)]
+
+
+def thread_upsert(new_thread, names=None, **updates):
+    """Create a statement to insert a thread, with `INSERT ... ON CONFLICT`,
+    or, if a thread with the same `client_id` exists, to apply the `updates`
+    to that thread.
+
+    `new_thread` may be a dictionary of column values, or a select statement
+    of the values of the columns in the list `names`. The values of `updates`
+    are expressions, or functions of the `excluded` row of values that were
+    to be inserted.
+    """
+    t = tables.thread
+    stmt = sqlalchemy.dialects.postgresql.insert(t)
+    if names is None:
+        stmt = stmt.values(**new_thread)
+    else:
+        stmt = stmt.from_select(names, new_thread)
+    set_ = {
+        k: v(stmt.excluded) if callable(v) else v
+        for k, v in updates.items()
+    }
+    return stmt.on_conflict_do_update(
+        index_elements=[t.c.client_id], set_=set_)
 
 
 def insert_identity(new_identity=None):
@@ -179,6 +1012,7 @@ def update_identity(identity_id, identity_edit, old_identity):
             'Identity {0} not found'.format(identity_id))
 
     identity = dict(result.items())
+    invalidation.publish(('identity', identity_id))
 
     # Run on_post_update hooks
     # ext.exec_hooks(ext.OnPostIdentityUpdate, old_identity, identity)
@@ -207,7 +1041,8 @@ def fetch_identity(identity_id):
 def update_comment(comment_id, comment_edit, old_comment,
                    update_modified=False):
     """Update the comment in the database in response to a request
-    from the author. The `modified` timestamp will be set to the current time.
+    from the author, and increment the version of its thread, in a single
+    statement. The `modified` timestamp will be set to the current time.
 
     Update requests should be validated before being passed to this function.
     """
@@ -231,10 +1066,19 @@ def update_comment(comment_id, comment_edit, old_comment,
     if update_modified:
         stmt = stmt.values(modified=sa.text('NOW()'))
 
+    # Store the rendered text if the text has changed.
+    if 'text' in comment_edit:
+        stmt = stmt.values(**render_text(comment_edit['text']))
+
     # Run on_pre_update hooks
     ext.exec_hooks(ext.OnPreCommentUpdate, old_comment, comment_edit)
 
-    result = db.engine.execute(stmt).first()
+    # Increment the version of the comment's thread in the same statement,
+    # so that the updated comment is never served with the old version.
+    thread_id = sa.select([t.c.thread_id]).where(t.c.id == comment_id)
+    stmt, bindparams = cte_chain([thread_version_bump(thread_id), stmt])
+
+    result = db.engine.execute(stmt, **bindparams).first()
     if not result:
         raise CommentNotFoundError('Comment {0} not found'.format(comment_id))
 
@@ -246,11 +1090,70 @@ def update_comment(comment_id, comment_edit, old_comment,
     return comment
 
 
-def validate_parent_exists(parent):
-    """Validate that the parent exists in the database."""
+def render_text(text):
+    """Render comment text with the configured `CommentRenderer`, returning
+    the values of the `rendered_text` and `rendered_key` columns.
+    """
+    renderer = flask.current_app.comment_renderer
+    return {
+        'rendered_text': renderer.render(text),
+        'rendered_key': renderer.render_key(),
+    }
+
+
+def fetch_comments_to_render(render_key, after_id=None, limit=1000,
+                             render_all=False):
+    """Fetch the `id` and `text` of up to `limit` comments whose stored
+    rendered text was not produced with `render_key`, ordered by `id`.
+    If `render_all` is True, fetch all comments regardless of the key.
+
+    Fetches comments after `after_id`, if given, so that all comments can be
+    processed in batches.
+    """
     t = tables.comment
-    stmt = sa.select([sa.exists([1]).where(t.c.id == parent)])
-    return db.engine.execute(stmt).scalar()
+    stmt = (
+        sa.select([t.c.id, t.c.text])
+        .order_by(sa.asc(t.c.id))
+        .limit(limit)
+    )
+    if after_id is not None:
+        stmt = stmt.where(t.c.id > after_id)
+    if not render_all:
+        stmt = stmt.where(sa.or_(
+            t.c.rendered_key.is_(None),
+            t.c.rendered_key != render_key,
+        ))
+    return db.engine.execute(stmt).fetchall()
+
+
+def update_rendered_texts(rendered_texts):
+    """Update the stored rendered text of comments, given a list of
+    dictionaries with `comment_id`, `rendered_text`, and `rendered_key` keys,
+    and increment the version of their threads, in one transaction.
+
+    Returns the list of ids of the updated threads.
+    """
+    t_comment = tables.comment
+    t_thread = tables.thread
+    stmt = (
+        t_comment.update()
+        .where(t_comment.c.id == sa.bindparam('comment_id'))
+        .values(
+            rendered_text=sa.bindparam('rendered_text'),
+            rendered_key=sa.bindparam('rendered_key'),
+        )
+    )
+    comment_ids = [r['comment_id'] for r in rendered_texts]
+    bump = (
+        thread_version_bump(
+            sa.select([t_comment.c.thread_id])
+            .where(t_comment.c.id.in_(comment_ids))
+        )
+        .returning(t_thread.c.id)
+    )
+    with db.engine.begin() as conn:
+        conn.execute(stmt, rendered_texts)
+        return [row[0] for row in conn.execute(bump)]
 
 
 def insert_identity_comment(identity_comment):
@@ -272,23 +1175,45 @@ def insert_identity_comment(identity_comment):
 
 def cte_chain(statements):
     """Chain a sequence of statements using a CTE. The result of the last
-    statement will be returned when RETURNING is used."""
+    statement will be returned when RETURNING is used.
+
+    The statements before the last are named `t0`, `t1`, and so on, so that
+    later statements may select from the results of earlier ones, for example
+    with `sa.table('t0', sa.column('id'))`.
+
+    Returns the SQL string and the dictionary of its parameters. Parameters
+    are renamed with the name of their statement as a prefix, so that
+    different statements may use the same names, and their values are
+    processed for their types, as when executing each statement.
+    """
+    dialect = sqlalchemy.dialects.postgresql.dialect()
     parts = []
     bindparams = {}
     for i, stmt in enumerate(statements):
-        compiled = stmt.compile(
-            dialect=sqlalchemy.dialects.postgresql.dialect())
+        compiled = stmt.compile(dialect=dialect)
+        prefix = 't{0}_'.format(i)
+        params = {}
+        for name, value in compiled.params.items():
+            processor = compiled.binds[name].type.dialect_impl(
+                dialect).bind_processor(dialect)
+            if processor is not None:
+                value = processor(value)
+            params[prefix + name] = value
+        sql = BIND_PARAM_RE.sub(
+            lambda m: '%({0}{1})s'.format(prefix, m.group(1)),
+            compiled.string)
+
         # If first statement, open the WITH statement and use an alias.
         if i == 0:
-            part = "WITH t{0} AS ( {1} )".format(i, compiled)
+            part = "WITH t{0} AS ( {1} )".format(i, sql)
         # If last statement, do not prefix with comma and do not use an alias.
         elif i == (len(statements) - 1):
-            part = "{0}".format(compiled)
+            part = "{0}".format(sql)
         # Otherwise, if not first or last, prefix with comma and use an alias.
         else:
-            part = ", t{0} AS ( {1} )".format(i, compiled)
+            part = ", t{0} AS ( {1} )".format(i, sql)
 
-        bindparams = utils.merge_fail_on_conflict(bindparams, compiled.params)
+        bindparams = utils.merge_fail_on_conflict(bindparams, params)
         parts.append(part)
 
     stmt = '\n'.join(parts)
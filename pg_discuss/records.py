@@ -0,0 +1,220 @@
+"""Compact records for bulk comment processing.
+
+A thread with tens of thousands of comments is fetched, serialized, and built
+into a tree one comment at a time. Representing each comment as a `dict`
+costs a hash table per comment, with its own copy of the keys. Instead,
+records of the same kind share a single :class:`Columns` object which maps
+each key to an index, and each record only stores a list of values.
+
+Records implement the mutable mapping interface, so that extension hooks can
+read and modify them as they would a `dict`. Keys may be added to and removed
+from a record at any time: a new key is added to the shared columns, and
+records without a value for a column simply do not have that key.
+
+Records are converted to `dict` only when they are encoded to JSON, by the
+encoder returned by :func:`json_encoder`, which calls back into Python for
+each record. So comments which are prepared to be sent to the client, and are
+then encoded, are plain dicts instead. A :class:`FragmentRecord` also
+carries its own JSON encoding, which the encoder splices into the document
+instead of encoding the record again.
+"""
+import threading
+
+import simplejson
+
+from . import _compat
+
+# Marker for a column without a value in a record.
+_MISSING = object()
+
+
+class Columns(object):
+    """Ordered set of keys shared by records, mapping each key to the index of
+    its value.
+
+    Columns only grow, so that the index of a key never changes. Adding keys
+    is thread-safe, so that records in concurrent requests may share columns.
+    """
+    __slots__ = ('names', 'index', '_lock')
+
+    def __init__(self, names=()):
+        self.names = []
+        self.index = {}
+        self._lock = threading.Lock()
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name):
+        """Add the key `name`, if it is not already a column, and return its
+        index.
+        """
+        i = self.index.get(name)
+        if i is None:
+            with self._lock:
+                i = self.index.get(name)
+                if i is None:
+                    i = len(self.names)
+                    # Append the name before indexing it, so that readers never
+                    # see an index without a name.
+                    self.names.append(name)
+                    self.index[name] = i
+        return i
+
+
+class Record(_compat.MutableMapping):
+    """Mapping with a list of values for a shared set of :class:`Columns`.
+
+    `values` are given in the order of `columns`, and may be shorter than the
+    columns, in which case the remaining keys are not set.
+    """
+    __slots__ = ('_columns', '_values')
+
+    def __init__(self, columns, values=()):
+        self._columns = columns
+        self._values = list(values)
+
+    @classmethod
+    def from_rows(cls, keys, rows):
+        """Make a list of records from a sequence of row tuples, with the
+        same `keys` for each row.
+        """
+        columns = Columns(keys)
+        return [cls(columns, row) for row in rows]
+
+    def __getitem__(self, key):
+        try:
+            value = self._values[self._columns.index[key]]
+        except (KeyError, IndexError):
+            raise KeyError(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        i = self._columns.add(key)
+        values = self._values
+        if i >= len(values):
+            values.extend([_MISSING] * (i + 1 - len(values)))
+        values[i] = value
+
+    def __delitem__(self, key):
+        # Raises a KeyError if the key is not set.
+        self[key]
+        self._values[self._columns.index[key]] = _MISSING
+
+    def __contains__(self, key):
+        i = self._columns.index.get(key)
+        return (
+            i is not None
+            and i < len(self._values)
+            and self._values[i] is not _MISSING
+        )
+
+    def __iter__(self):
+        for name, value in zip(self._columns.names, self._values):
+            if value is not _MISSING:
+                yield name
+
+    def __len__(self):
+        return sum(1 for value in self._values if value is not _MISSING)
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, self.for_json())
+
+    def get(self, key, default=None):
+        i = self._columns.index.get(key)
+        if i is None or i >= len(self._values):
+            return default
+        value = self._values[i]
+        return default if value is _MISSING else value
+
+    def copy(self):
+        """Return a shallow copy, which shares the columns of this record."""
+        return type(self)(self._columns, self._values)
+
+    def for_json(self):
+        """Return the record as a `dict`, to be encoded to JSON."""
+        return {name: value
+                for name, value in zip(self._columns.names, self._values)
+                if value is not _MISSING}
+
+
+class FragmentRecord(Record):
+    """Record with a pre-encoded JSON `fragment` of its `values`.
+
+    The values at the time the fragment was encoded are kept as the
+    `snapshot`. Keys may still be set on the record, for example to nest
+    replies under a comment, in which case only the keys set since the
+    snapshot are encoded, and spliced into the fragment.
+    """
+    __slots__ = ('fragment', 'snapshot')
+
+    def __init__(self, columns, snapshot, fragment):
+        super(FragmentRecord, self).__init__(columns, snapshot)
+        self.snapshot = tuple(snapshot)
+        self.fragment = fragment
+
+    @classmethod
+    def from_record(cls, record, encoder):
+        """Encode `record` with the `JSONEncoder` instance `encoder`, and
+        return a fragment record with the same columns and values.
+        """
+        return cls(record._columns, record._values,
+                   encoder.encode(record.for_json()))
+
+    def copy(self):
+        """Return a shallow copy, as a plain record without the fragment."""
+        return Record(self._columns, self._values)
+
+    def encode_with(self, encoder):
+        """Return the JSON encoding of the record, by splicing the keys set
+        since the snapshot, encoded with `encoder`, into the fragment.
+
+        Returns None if a key of the snapshot has since been changed or
+        removed, in which case the whole record must be encoded.
+        """
+        snapshot = self.snapshot
+        num_snapshot = len(snapshot)
+        added = {}
+        for i, (name, value) in enumerate(
+                zip(self._columns.names, self._values)):
+            old = snapshot[i] if i < num_snapshot else _MISSING
+            if value is old:
+                continue
+            if old is _MISSING:
+                added[name] = value
+            elif type(value) is not type(old) or value != old:
+                return None
+        if not added:
+            return self.fragment
+        # Keys set since the snapshot follow the keys of the fragment.
+        return ''.join([
+            self.fragment[:-1],
+            encoder.item_separator,
+            encoder.encode(added)[1:],
+        ])
+
+
+def json_encoder(encoder_cls):
+    """Return a subclass of the `JSONEncoder` class `encoder_cls` which also
+    encodes records, as objects.
+
+    Records are not `dict` instances, so the encoder calls `default` for
+    each record, which returns the record as a `dict`, or, for a
+    :class:`FragmentRecord`, as `simplejson.RawJSON` to be spliced into the
+    document. Other values are left to the `default` method of `encoder_cls`.
+    """
+    class RecordJSONEncoder(encoder_cls):
+        def default(self, obj):
+            if isinstance(obj, FragmentRecord):
+                encoded = obj.encode_with(self)
+                if encoded is not None:
+                    return simplejson.RawJSON(encoded)
+            if isinstance(obj, Record):
+                return obj.for_json()
+            return super(RecordJSONEncoder, self).default(obj)
+
+    return RecordJSONEncoder
@@ -0,0 +1,106 @@
+"""Render comment text in parallel, with a pool of worker processes.
+
+Rendering is CPU-bound, so rendering the comments of a very large thread on
+one core can dominate the latency of a fetch. :class:`PooledRenderer` wraps
+the configured `CommentRenderer` driver, and splits large batches of texts
+across a persistent pool of worker processes. Small batches are rendered
+inline, since sending the texts to the workers and the results back costs more
+than rendering them. See `tests/perf/render_pool.py` to find the crossover
+point for a renderer and machine.
+
+The pool is created on first use in each process, so that it is created after
+the app server forks its workers. The worker processes are forked from the
+process which creates the pool, and inherit its renderer.
+"""
+import multiprocessing
+import os
+import threading
+
+from . import ext
+
+# Renderer of a worker process, inherited from the process which created the
+# pool.
+_worker_renderer = None
+
+
+def _init_worker(renderer):
+    global _worker_renderer
+    _worker_renderer = renderer
+
+
+def _render_chunk(texts):
+    return _worker_renderer.render_many(texts)
+
+
+class PooledRenderer(ext.CommentRenderer):
+    """Renderer which renders batches of at least `threshold` texts with the
+    `renderer` driver in a pool of `processes` worker processes, and smaller
+    batches inline.
+    """
+
+    def __init__(self, renderer, processes, threshold, app=None):
+        super(PooledRenderer, self).__init__(app)
+        self.renderer = renderer
+        self.processes = processes
+        self.threshold = threshold
+        self._pool = None
+        # Process id of the process which created the pool. A pool inherited
+        # through a fork cannot be used.
+        self._pool_pid = None
+        self._lock = threading.Lock()
+
+    def render(self, text, **extras):
+        return self.renderer.render(text)
+
+    def render_key(self, **extras):
+        # Parallel rendering does not change the output.
+        return self.renderer.render_key()
+
+    def render_many(self, texts, **extras):
+        """Render the texts in the worker pool, if there are at least
+        `threshold` of them. Each worker renders a contiguous chunk of the
+        texts.
+        """
+        texts = list(texts)
+        if len(texts) < self.threshold:
+            return self.renderer.render_many(texts)
+        chunk_size = -(-len(texts) // self.processes)
+        chunks = [texts[i:i + chunk_size]
+                  for i in range(0, len(texts), chunk_size)]
+        rendered = []
+        for chunk in self.get_pool().map(_render_chunk, chunks):
+            rendered.extend(chunk)
+        return rendered
+
+    def get_pool(self):
+        """Get the worker pool of the current process, creating it if
+        needed.
+        """
+        pid = os.getpid()
+        if self._pool_pid != pid:
+            with self._lock:
+                if self._pool_pid != pid:
+                    self._pool = _fork_context().Pool(
+                        self.processes,
+                        initializer=_init_worker,
+                        initargs=(self.renderer,),
+                    )
+                    self._pool_pid = pid
+        return self._pool
+
+    def close(self):
+        """Stop the worker pool of the current process, if any."""
+        with self._lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.terminate()
+                self._pool.join()
+            self._pool = None
+            self._pool_pid = None
+
+
+def _fork_context():
+    # Workers must be forked to inherit the renderer, which may not be
+    # picklable. Python 2 always forks.
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing  # pragma: no cover
@@ -1,8 +1,15 @@
 """Functions to prepare comments and threads for serialization."""
+import hashlib
+import itertools
+import types
+
 import flask
 import markupsafe
+import sqlalchemy as sa
 
 from . import ext
+from . import records
+from . import tables
 from . import _compat
 
 # Fields which will be serialized by default when sent to client.
@@ -15,62 +22,295 @@ DEFAULT_COMMENT_WHITELIST = [
     'text',
 ]
 
+# Fields of `custom_json` which are copied to the client comment, if set.
+CUSTOM_JSON_WHITELIST = [
+    'deleted',
+]
+
 DEFAULT_THREAD_WHITELIST = [
     'id',
     'client_id',
 ]
 
 
-def to_client_comment(raw_comment, plain=False):
-    """A convenience wrapper for `_to_client_comment`. Should be used
-    when only single comments are processed within a request.
+class CommentSerializer(object):
+    """Plan to prepare comments for serialization to JSON, compiled once per
+    app from the configured extensions and `CommentRenderer` driver.
+
+    Work that depends only on configuration, such as finding the comment
+    serialization hooks of `extensions`, in order, and the fields that may
+    need escaping, is done when the serializer is created, rather than for
+    every comment. The compiled functions are `serialize`, to serialize a
+    single comment, and `serialize_many`, to serialize a list of comments.
 
-    For bulk comment processing, there is a significant speedup to using
-    _to_client_comment directly. See :func:`pg_discuss.views.fetch` for
-    an example.
+    If a `fragment_cache` and `JSONEncoder` instance `encoder` are given,
+    `serialize_many` caches each client comment with its JSON encoding, as a
+    :class:`pg_discuss.records.FragmentRecord`, which the encoder splices
+    into the document with a single call to its `default` method, rather
+    than encoding the comment again. Comments are cached by id and
+    `row_version`, which changes whenever the row is updated, so only new and
+    changed comments are serialized and encoded again. Comments without a
+    `row_version` are not cached. The serialization of a comment must only
+    depend on its row, and the cache must not be shared with another
+    serializer.
+
+    `fingerprint` is a short digest of the `render_key` of the renderer and
+    the serialization hooks, which changes whenever the configuration changes
+    the serialization of comments.
     """
-    app = flask.current_app
-    hook_map = app.hook_map
-    renderer = app.comment_renderer
-    return _to_client_comment(hook_map, renderer, raw_comment, plain)
 
+    def __init__(self, extensions, renderer, fragment_cache=None,
+                 encoder=None):
+        self.whitelist = tuple(DEFAULT_COMMENT_WHITELIST)
+        # Columns shared by the cached client comments, starting with the
+        # whitelisted fields. Fields added by hooks are added to the columns
+        # as they are set.
+        self.columns = records.Columns(self.whitelist)
+        # List of `(is_batch_hook, hook_method)`, in extension order. The
+        # batch hook is preferred if an extension implements both.
+        hooks = []
+        hook_exts = []
+        for e in extensions:
+            if isinstance(e, ext.OnPreCommentsSerialize):
+                hooks.append((True, e.on_pre_comments_serialize))
+            elif isinstance(e, ext.OnPreCommentSerialize):
+                hooks.append((False, e.on_pre_comment_serialize))
+            else:
+                continue
+            hook_exts.append(e)
+        self.hooks = tuple(hooks)
+        self.escape_fields = get_escape_fields(self.whitelist, hook_exts)
+        self.renderer = renderer
+        self.render_key = renderer.render_key()
+        self.fingerprint = hashlib.sha1(_compat.to_bytes(repr((
+            self.render_key,
+            ['{0}.{1}'.format(type(e).__module__, type(e).__name__)
+             for e in hook_exts],
+        )))).hexdigest()[:8]
+        self.fragment_cache = fragment_cache
+        self.encoder = encoder
+        self.serialize, self.serialize_many = self._compile()
+
+    def serialize_iter(self, raw_comments, batch_size):
+        """Prepare an iterable of comments for serialization to JSON, with
+        `serialize_many` on batches of `batch_size` comments. Yields the
+        client comments.
+        """
+        raw_comments = iter(raw_comments)
+        while True:
+            batch = list(itertools.islice(raw_comments, batch_size))
+            if not batch:
+                return
+            for client_comment in self.serialize_many(batch):
+                yield client_comment
+
+    def _compile(self):
+        # Bind the plan to local variables of closures, which are faster to
+        # access than attributes.
+        whitelist = self.whitelist
+        columns = self.columns
+        hooks = self.hooks
+        escape_fields = self.escape_fields
+        render = self.renderer.render
+        render_many = self.renderer.render_many
+        render_key = self.render_key
+        string_types = _compat.string_types
+        escape = markupsafe.escape
+        Record = records.Record
+        FragmentRecord = records.FragmentRecord
+        fragment_cache = self.fragment_cache
+        encoder = self.encoder
+
+        def prepare(raw_comment):
+            """Make the client comment with the whitelisted attributes."""
+            client_comment = {k: raw_comment[k] for k in whitelist}
+
+            # Extract whitelisted attributes, such as `deleted`, from custom
+            # json as well.
+            custom_json = raw_comment['custom_json']
+            for k in CUSTOM_JSON_WHITELIST:
+                if k in custom_json:
+                    client_comment[k] = custom_json[k]
+
+            return client_comment
+
+        def escape_strings(client_comment):
+            """Escape the client comment, once the hooks have run."""
+            # Escape string fields, besides `text`, which may be rendered into
+            # DOM. If an extension has not declared the fields it adds, every
+            # field must be checked.
+            if escape_fields is None:
+                for k, v in client_comment.items():
+                    if isinstance(v, string_types) and k != 'text':
+                        client_comment[k] = escape(v)
+            else:
+                for k in escape_fields:
+                    v = client_comment.get(k)
+                    if isinstance(v, string_types):
+                        client_comment[k] = escape(v)
+
+        def is_rendered(raw_comment, client_comment):
+            """Use the text rendered when the comment was written, unless it
+            was rendered by a different renderer or renderer configuration.
+            Returns False if the text must be rendered.
+            """
+            rendered_text = raw_comment.get('rendered_text')
+            if (
+                rendered_text is not None
+                and raw_comment['rendered_key'] == render_key
+            ):
+                client_comment['text'] = rendered_text
+                return True
+            return False
+
+        def serialize(raw_comment, plain=False):
+            """Prepare a comment for serialization to JSON.
+
+            Only preserves whitelisted attributes. Calls any comment
+            serialization extensions, and the CommentRenderer driver. The
+            client comment is a plain `dict`, rather than a compact record,
+            so that the C-accelerated JSON encoder encodes it without calling
+            back into Python.
+            """
+            client_comment = prepare(raw_comment)
+            for is_batch, hook in hooks:
+                if is_batch:
+                    hook([raw_comment], [client_comment])
+                else:
+                    hook(raw_comment, client_comment)
+            escape_strings(client_comment)
+            # Render comment text using configured CommentRenderer. The
+            # renderer should handle escaping of the comment text.
+            if not plain and not is_rendered(raw_comment, client_comment):
+                client_comment['text'] = render(client_comment['text'])
+            return client_comment
+
+        def serialize_many(raw_comments, plain=False):
+            """Prepare a list of comments for serialization to JSON, as by
+            `serialize`.
+
+            This is a performance critical function - it is called for all
+            comments when a thread is fetched. Batch hooks, and the renderer,
+            are called once for the whole list.
+            """
+            client_comments = [prepare(c) for c in raw_comments]
+            for is_batch, hook in hooks:
+                if is_batch:
+                    hook(raw_comments, client_comments)
+                else:
+                    for raw_comment, client_comment in zip(
+                            raw_comments, client_comments):
+                        hook(raw_comment, client_comment)
+            for client_comment in client_comments:
+                escape_strings(client_comment)
+            if not plain:
+                stale = [
+                    client_comment for raw_comment, client_comment
+                    in zip(raw_comments, client_comments)
+                    if not is_rendered(raw_comment, client_comment)
+                ]
+                if stale:
+                    texts = render_many([c['text'] for c in stale])
+                    for client_comment, text in zip(stale, texts):
+                        client_comment['text'] = text
+            return client_comments
+
+        if not (fragment_cache is not None and fragment_cache.max_bytes
+                and encoder is not None):
+            return serialize, serialize_many
+
+        cache_get = fragment_cache.get
+        cache_set = fragment_cache.set
+
+        def serialize_many_cached(raw_comments, plain=False):
+            """Prepare a list of comments for serialization to JSON, as by
+            `serialize_many`, using the cached client comments of comments
+            which have not changed.
+            """
+            client_comments = []
+            # List of `(index, cache key, raw comment)` of comments to
+            # serialize.
+            misses = []
+            for raw_comment in raw_comments:
+                row_version = raw_comment.get('row_version')
+                key = cached = None
+                if row_version is not None:
+                    key = (raw_comment['id'], row_version, plain)
+                    cached = cache_get(key)
+                if cached is None:
+                    misses.append((len(client_comments), key, raw_comment))
+                    client_comments.append(None)
+                else:
+                    snapshot, fragment = cached
+                    client_comments.append(
+                        FragmentRecord(columns, snapshot, fragment))
+            if misses:
+                fresh = serialize_many([m[2] for m in misses], plain)
+                for (i, key, _), client_comment in zip(misses, fresh):
+                    record = Record(columns)
+                    record.update(client_comment)
+                    client_comment = FragmentRecord.from_record(
+                        record, encoder)
+                    client_comments[i] = client_comment
+                    if key is not None:
+                        fragment = client_comment.fragment
+                        cache_set(key, (client_comment.snapshot, fragment),
+                                  len(fragment))
+            return client_comments
 
-def _to_client_comment(hook_map, renderer, raw_comment, plain=False):
-    """Prepare comments for serialization to JSON.
+        return serialize, serialize_many_cached
 
-    Only preserves whitelisted attributes. Calls any `OnPreCommentSerialize`
-    extensions, and the CommentRenderer driver.
 
-    Takes `app` as an arg to eliminate repeated `current_app` lookups.
+def get_escape_fields(whitelist, hook_exts):
+    """Get the tuple of fields of client comments which may be strings, and
+    so need escaping, besides `text`.
 
-    This is a performance critical function - it is called for every
-    comment when a thread is fetched.
+    The types of whitelisted fields are known from the comment table, and
+    the types of fields added by the extensions `hook_exts` are declared
+    with :attr:`pg_discuss.ext.OnPreCommentSerialize.serialized_fields`.
+    Fields copied from `custom_json` may have any type, so are always
+    checked.
+    Returns None if any extension has not declared its fields, in which case
+    every field must be checked.
     """
-    client_comment = {k: raw_comment[k] for k in DEFAULT_COMMENT_WHITELIST}
+    fields = [
+        c.name for c in tables.comment.c
+        if c.name in whitelist and isinstance(c.type, sa.String)
+    ] + CUSTOM_JSON_WHITELIST
+    for e in hook_exts:
+        if e.serialized_fields is None:
+            return None
+        fields.extend(k for k, types in e.serialized_fields.items()
+                      if _may_be_string(types))
+    return tuple(sorted(set(fields) - {'text'}))
 
-    # Extract `deleted` attribute from custom json as well.
-    if 'deleted' in raw_comment['custom_json']:
-        client_comment['deleted'] = raw_comment['custom_json']['deleted']
 
-    # Run on_comment_serialize hooks. Inline the `exec_hooks` function
-    # for performance.
-    args = (raw_comment, client_comment)
-    for ext_obj in hook_map[ext.OnPreCommentSerialize]:
-        ext_obj.on_pre_comment_serialize(*args)
+def _may_be_string(types):
+    if not isinstance(types, tuple):
+        types = (types,)
+    return any(issubclass(s, t) or issubclass(t, s)
+               for t in types for s in _compat.string_types)
 
-    # Escape string fields, besides `text`, which may be rendered into DOM.
-    # We have no way of knowing what fields extensions might add, so we need
-    # to do isinstance checks to see which are strings.
-    for k, v in client_comment.items():
-        if isinstance(v, _compat.string_types) and k != 'text':
-            client_comment[k] = markupsafe.escape(v)
 
-    # Render comment text using configured CommentRenderer. Th renderer should
-    # handle escaping of the comment text.
-    if not plain:
-        client_comment['text'] = renderer.render(client_comment['text'])
+def to_client_comment(raw_comment, plain=False):
+    """Prepare a single comment for serialization to JSON, with the
+    :class:`CommentSerializer` of the app.
+
+    For bulk comment processing, use `app.comment_serializer.serialize_many`
+    instead. See :func:`pg_discuss.views.fetch` for an example.
+    """
+    return flask.current_app.comment_serializer.serialize(raw_comment, plain)
+
+
+def wants_epoch_times(app):
+    """Return True if the configured JSON encoder driver encodes datetimes as
+    Unix timestamps, and so wants the timestamps of comments to be selected
+    as numbers, by declaring a true `wants_epoch_times` attribute.
 
-    return client_comment
+    When it does, the `created` and `modified` values of fetched comments are
+    numbers rather than datetimes, for both the raw and client comments.
+    """
+    return getattr(app.json_encoder, 'wants_epoch_times', False)
 
 
 def to_client_thread(raw_thread, comment_seq):
@@ -90,3 +330,103 @@ def to_client_thread(raw_thread, comment_seq):
                    client_thread)
 
     return client_thread
+
+
+def get_json_encoder(app):
+    """Instantiate the configured `JSONEncoder` driver with the same options
+    that `flask.jsonify` would use.
+    """
+    kwargs = {'sort_keys': app.config['JSON_SORT_KEYS']}
+    if not app.config['JSON_AS_ASCII']:
+        kwargs['ensure_ascii'] = False
+    return app.json_encoder(**kwargs)
+
+
+def iterencode_chunks(encoder, obj, chunk_size):
+    """Encode the dictionary `obj` to JSON incrementally, yielding UTF-8
+    encoded chunks of roughly `chunk_size` bytes.
+
+    The items of top-level lists, such as the comment collection of a thread,
+    are encoded one at a time. Top-level generators are encoded as lists, and
+    consumed as the chunks are produced. `JSONEncoder.iterencode` cannot be
+    used for this purpose since the C-accelerated encoder builds the list of
+    all fragments up front, which would hold the entire document in memory.
+
+    Items with replies nested too deeply for the recursion limit of the
+    encoder are encoded with :func:`iterencode_tree` instead.
+    """
+    def fragments():
+        yield '{'
+        keys = sorted(obj) if encoder.sort_keys else list(obj)
+        for i, k in enumerate(keys):
+            if i:
+                yield encoder.item_separator
+            yield encoder.encode(k) + encoder.key_separator
+            v = obj[k]
+            if isinstance(v, list) or isinstance(v, types.GeneratorType):
+                yield '['
+                for j, item in enumerate(v):
+                    if j:
+                        yield encoder.item_separator
+                    try:
+                        encoded = encoder.encode(item)
+                    except _compat.RecursionError:
+                        for fragment in iterencode_tree(encoder, item):
+                            yield fragment
+                    else:
+                        yield encoded
+                yield ']'
+            else:
+                yield encoder.encode(v)
+        yield '}'
+
+    # Buffer the fragments into larger chunks to avoid the overhead of many
+    # tiny writes to the client.
+    buf = []
+    buf_len = 0
+    for fragment in fragments():
+        buf.append(fragment)
+        buf_len += len(fragment)
+        if buf_len >= chunk_size:
+            yield _compat.to_bytes(''.join(buf))
+            buf = []
+            buf_len = 0
+    if buf:
+        yield _compat.to_bytes(''.join(buf))
+
+
+def iterencode_tree(encoder, node):
+    """Encode the tree of `node` to JSON, without recursion, yielding the
+    fragments of the encoding.
+
+    The `replies` of the nodes of a comment tree may be nested arbitrarily
+    deep, which the `JSONEncoder` instance `encoder` cannot encode without
+    exceeding the recursion limit. Instead, each node is encoded by `encoder`
+    without its `replies`, and the encoded replies are spliced in after the
+    other keys. This is slower than encoding the whole tree at once, since
+    the encoder is called for each node.
+    """
+    replies_key = encoder.encode('replies') + encoder.key_separator
+    # Stack of nodes to encode, and fragments to yield, as `(node, fragment)`.
+    stack = [(node, None)]
+    while stack:
+        n, fragment = stack.pop()
+        if fragment is not None:
+            yield fragment
+            continue
+        replies = n.get('replies') if isinstance(n, _compat.Mapping) else None
+        if not replies:
+            yield encoder.encode(n)
+            continue
+        encoded = encoder.encode(
+            {k: v for k, v in n.items() if k != 'replies'})
+        if encoded == '{}':
+            yield '{' + replies_key + '['
+        else:
+            yield encoded[:-1] + encoder.item_separator + replies_key + '['
+        stack.append((None, ']}'))
+        # Push in reverse, so that the first reply is popped first.
+        for i in range(len(replies) - 1, -1, -1):
+            stack.append((replies[i], None))
+            if i:
+                stack.append((None, encoder.item_separator))
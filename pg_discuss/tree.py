@@ -0,0 +1,58 @@
+"""Build and walk nested trees of comments.
+
+A tree is a node with a list of `replies`, each of which is a comment node
+with its own `replies`. The root of the tree is a plain `dict`, whose replies
+are the top-level comments of a thread, or the replies to a comment.
+
+Threads may be nested arbitrarily deep, so these functions do not recurse:
+the tree is built with a single pass over the sequence of comments, and
+walked with an explicit stack. The cost is linear in the number of comments,
+and does not depend on the depth of the tree.
+"""
+
+
+def build(comment_seq, parent_id=None):
+    """Build the tree of the replies to the comment with the id `parent_id`,
+    or of the top-level comments if `parent_id` is None, from a sequence of
+    comments in which each comment comes after its parent, and sibling
+    comments are in chronological order. A sequence sorted by `created`
+    time, or in path order, meets both requirements.
+
+    Returns a root node with the replies to `parent_id` as its replies. Each
+    comment in the sequence is given a list of `replies`. Comments whose
+    parent is neither `parent_id` nor in the sequence are left out of the
+    tree.
+    """
+    comment_tree = {'replies': []}
+    comment_dict = {}
+    for c in comment_seq:
+        c['replies'] = []
+        comment_dict[c['id']] = c
+        c_parent_id = c['parent_id']
+        if c_parent_id == parent_id:
+            comment_tree['replies'].append(c)
+        else:
+            parent = comment_dict.get(c_parent_id)
+            if parent is not None:
+                parent['replies'].append(c)
+    return comment_tree
+
+
+def walk(node):
+    """Yield each node of the tree under `node`, including `node` itself, and
+    its depth, in pre-order. The depth of `node` is 0.
+
+    Replies are yielded in order, each before its own replies. Nodes which
+    have been pruned of their `replies` are yielded, but not descended into.
+    """
+    stack = [(node, 0)]
+    pop = stack.pop
+    extend = stack.extend
+    while stack:
+        n, depth = pop()
+        yield n, depth
+        replies = n.get('replies')
+        if replies:
+            child_depth = depth + 1
+            # Push in reverse, so that the first reply is popped first.
+            extend((r, child_depth) for r in reversed(replies))
@@ -1,4 +1,14 @@
 """Generic utility functions for pg-discuss."""
+import calendar
+import datetime
+import re
+
+#: The Unix epoch as a naive datetime. Naive datetimes are interpreted as UTC,
+#: since the database connection timezone is set to UTC.
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Unix timestamp string, with an optional fractional part.
+TIMESTAMP_RE = re.compile(r'^(-?)([0-9]+)(?:\.([0-9]+))?\Z')
 
 
 class MergeConflict(Exception):
@@ -10,5 +20,36 @@ def merge_fail_on_conflict(dict1, dict2):
     for key in dict2.keys():
         if key in dict1:
             raise MergeConflict("key {} already exists".format(key))
-        else:
-            return dict(dict1, **dict2)
+    return dict(dict1, **dict2)
+
+
+def datetime_to_timestamp(dt):
+    """Format a timezone-aware datetime as a Unix timestamp string with
+    microsecond precision. Unlike a float, the string can be converted back to
+    the exact same datetime with `timestamp_to_datetime`.
+    """
+    total = calendar.timegm(dt.utctimetuple()) * 10**6 + dt.microsecond
+    seconds, microseconds = divmod(abs(total), 10**6)
+    return '{0}{1}.{2:06d}'.format('-' if total < 0 else '', seconds,
+                                   microseconds)
+
+
+def timestamp_to_datetime(timestamp):
+    """Parse a Unix timestamp string, with an optional fractional part, into a
+    naive UTC datetime. The sign applies to the fraction as well as the
+    seconds. Digits of the fraction beyond microsecond precision are ignored.
+
+    Raises a `ValueError` if the string is not a valid timestamp, or is out of
+    the range of `datetime`.
+    """
+    match = TIMESTAMP_RE.match(timestamp)
+    if not match:
+        raise ValueError('invalid timestamp: {0}'.format(timestamp))
+    sign_str, seconds_str, fraction_str = match.groups()
+    microseconds = int(fraction_str[:6].ljust(6, '0')) if fraction_str else 0
+    sign = -1 if sign_str else 1
+    try:
+        return EPOCH + sign * datetime.timedelta(seconds=int(seconds_str),
+                                                 microseconds=microseconds)
+    except OverflowError:
+        raise ValueError('timestamp out of range: {0}'.format(timestamp))
@@ -1,6 +1,7 @@
 """Minimal comment CRUD views.
 
  - fetch: fetch the list of comments for a thread
+ - fetch_page: fetch a page of the list of comments for a thread
  - new: create a new comment
  - view: fetch a single comment
  - edit: update an existing comment
@@ -15,6 +16,9 @@ from . import forms
 from . import serialize
 from . import ext
 from . import auth_forms
+from . import identity
+from . import utils
+from . import _compat
 
 
 def check_mimetype(f):
@@ -32,19 +36,232 @@ def check_mimetype(f):
 
 
 def fetch(thread_cid):
-    """View to fetch the thread and it's comment collection as JSON."""
-    raw_thread = queries.fetch_thread_by_client_id(thread_cid)
+    """View to fetch the thread and it's comment collection as JSON.
+
+    The response has an `ETag` derived from the thread version and the
+    serialization configuration, see :func:`thread_etag`. Conditional
+    requests with a matching `If-None-Match` header are answered with
+    `304 Not Modified` after looking up only the thread.
+
+    If the thread cache is enabled, encoded responses are cached per thread
+    and query string until a comment of the thread is written.
+    """
+    app = flask.current_app
+    thread_cache = app.thread_cache
+    if_none_match = flask.request.if_none_match
+
+    cache_key = None
+    if thread_cache.max_bytes:
+        cache_key = (
+            thread_cid,
+            tuple(sorted(flask.request.args.items(multi=True))),
+            app.comment_serializer.fingerprint,
+        )
+        cached = thread_cache.get(cache_key)
+        if cached is not None:
+            chunks, etag = cached
+            if if_none_match.contains_weak(etag):
+                return not_modified(etag)
+            resp = app.response_class(chunks, mimetype='application/json')
+            return set_revalidate(resp, etag)
+        # Values computed before a concurrent write must not be cached.
+        generation = thread_cache.generation
+
+    raw_thread = None
+    if if_none_match:
+        raw_thread = queries.fetch_thread_by_client_id(thread_cid)
+        if raw_thread:
+            etag = thread_etag(raw_thread)
+            if if_none_match.contains_weak(etag):
+                return not_modified(etag)
+
+    hook_map = app.hook_map
+    serializer = app.comment_serializer
+    epoch_times = serialize.wants_epoch_times(app)
+    fetch_options = {}
+    ext.exec_hooks(ext.OnPreThreadFetch, fetch_options)
+
+    if 'reply_limit' in fetch_options or 'depth_limit' in fetch_options:
+        # Extensions may set options to fetch only part of the comment tree.
+        raw_thread, comments_seq = queries.fetch_thread_tree_by_client_id(
+            thread_cid,
+            reply_limit=fetch_options.get('reply_limit'),
+            depth_limit=fetch_options.get('depth_limit'),
+            parent_id=fetch_options.get('parent_id'),
+            after=fetch_options.get('after'),
+            predicates=fetch_options.get('predicates', ()),
+            epoch_times=epoch_times,
+        )
+        stream_rows = False
+    else:
+        # If no extension needs the whole comment collection, fetch no more
+        # comments than the streaming threshold along with the thread. The
+        # comments of larger threads are then streamed from the database as
+        # the response is encoded, so that they are never all held in memory.
+        # Only threads this large read their first comments twice.
+        limit = None
+        if not fetch_options and not hook_map[ext.OnPreThreadSerialize]:
+            limit = app.config['STREAMING_RESPONSE_THRESHOLD']
+        # Fetch the thread and its comments in a single round trip.
+        raw_thread, comments_seq = (
+            queries.fetch_thread_with_comments_by_client_id(
+                thread_cid,
+                predicates=fetch_options.get('predicates', ()),
+                order_by=fetch_options.get('order_by'),
+                epoch_times=epoch_times,
+                limit=limit,
+            ))
+        stream_rows = limit is not None and len(comments_seq) >= limit
+
+    if stream_rows:
+        comments_seq = serializer.serialize_iter(
+            queries.iter_comments_by_thread_client_id(
+                thread_cid, epoch_times=epoch_times),
+            app.config['COMMENT_STREAM_BATCH_SIZE'],
+        )
+    else:
+        comments_seq = serializer.serialize_many(comments_seq)
+
     # If the thread has not yet been created, return an empty JSON object.
     if not raw_thread:
         return flask.jsonify({})
-    comments_seq = queries.fetch_comments_by_thread_client_id(thread_cid)
-    app = flask.current_app
-    hook_map = app.hook_map
-    renderer = app.comment_renderer
-    comments_seq = [serialize._to_client_comment(
-        hook_map, renderer, c) for c in comments_seq]
+    etag = thread_etag(raw_thread)
     client_thread = serialize.to_client_thread(raw_thread, comments_seq)
-    return flask.jsonify(client_thread)
+
+    if cache_key is not None:
+        # Cache the encoded chunks once the response has been sent.
+        def on_complete(chunks):
+            thread_cache.set(
+                cache_key,
+                (chunks, etag),
+                sum(len(c) for c in chunks),
+                tag=raw_thread['id'],
+                generation=generation,
+            )
+        resp = stream_json(client_thread, on_complete)
+    # Stream the response for large threads, so that the encoded JSON
+    # document is never held in memory all at once.
+    elif stream_rows or _should_stream(app, len(comments_seq)):
+        resp = stream_json(client_thread)
+    else:
+        try:
+            resp = flask.jsonify(client_thread)
+        except _compat.RecursionError:
+            # Deeply nested replies are encoded without recursion.
+            resp = stream_json(client_thread)
+
+    return set_revalidate(resp, etag)
+
+
+def _should_stream(app, num_comments):
+    threshold = app.config['STREAMING_RESPONSE_THRESHOLD']
+    return threshold is not None and num_comments >= threshold
+
+
+def thread_etag(raw_thread):
+    """Get the entity tag for the thread, which changes whenever one of its
+    comments is inserted or updated, or the configuration changes the
+    serialization of comments, such as the renderer or its flags.
+    """
+    return '{0}-{1}-{2}'.format(
+        raw_thread['id'],
+        raw_thread['version'],
+        flask.current_app.comment_serializer.fingerprint,
+    )
+
+
+def set_revalidate(resp, etag):
+    """Set the `ETag` of the response, and require clients to revalidate
+    their cached copy on every request.
+    """
+    resp.set_etag(etag)
+    resp.cache_control.no_cache = True
+    return resp
+
+
+def not_modified(etag):
+    """Create a `304 Not Modified` response for the `ETag`."""
+    resp = flask.current_app.response_class(status=304)
+    return set_revalidate(resp, etag)
+
+
+def stream_json(obj, on_complete=None):
+    """Create a response which encodes `obj` to JSON incrementally as the
+    response is sent, using the configured `JSONEncoder` driver.
+
+    If given, `on_complete` is called with the tuple of encoded chunks once
+    the whole response has been sent.
+    """
+    app = flask.current_app
+    encoder = serialize.get_json_encoder(app)
+    chunks = serialize.iterencode_chunks(
+        encoder, obj, app.config['STREAMING_RESPONSE_CHUNK_SIZE'])
+    if on_complete is not None:
+        chunks = _tee_chunks(chunks, on_complete)
+    # Keep the request context, since comments may be serialized as they are
+    # encoded.
+    chunks = flask.stream_with_context(chunks)
+    return app.response_class(chunks, mimetype='application/json')
+
+
+def _tee_chunks(chunks, on_complete):
+    sent = []
+    for chunk in chunks:
+        sent.append(chunk)
+        yield chunk
+    on_complete(tuple(sent))
+
+
+def fetch_page(thread_cid):
+    """View to fetch a page of a thread's comment collection as JSON.
+
+    Pages are requested with the `limit` query parameter, and the
+    `after_created` and `after_id` parameters of the continuation cursor
+    returned as `next` with the previous page. `next` is null on the last
+    page.
+    """
+    app = flask.current_app
+    args = flask.request.args
+
+    try:
+        limit = int(args.get('limit', app.config['PAGINATED_FETCH_LIMIT']))
+    except ValueError:
+        flask.abort(400, 'limit must be an integer')
+    if not 0 < limit <= app.config['PAGINATED_FETCH_MAX_LIMIT']:
+        flask.abort(400, 'limit must be between 1 and {0}'.format(
+            app.config['PAGINATED_FETCH_MAX_LIMIT']))
+
+    after_created = args.get('after_created')
+    after_id = args.get('after_id')
+    if (after_created is None) != (after_id is None):
+        flask.abort(400, 'after_created and after_id must be given together')
+    if after_created is not None:
+        try:
+            after_created = utils.timestamp_to_datetime(after_created)
+            after_id = int(after_id)
+        except ValueError:
+            flask.abort(400, 'invalid after_created or after_id')
+
+    # Fetch one extra comment to find out if there is a next page.
+    comments_seq = queries.fetch_comments_page_by_thread_client_id(
+        thread_cid,
+        limit + 1,
+        after_created=after_created,
+        after_id=after_id,
+    )
+    has_next = len(comments_seq) > limit
+    del comments_seq[limit:]
+
+    next_cursor = None
+    if has_next:
+        last = comments_seq[-1]
+        next_cursor = {
+            'after_created': utils.datetime_to_timestamp(last['created']),
+            'after_id': last['id'],
+        }
+
+    comments_seq = app.comment_serializer.serialize_many(comments_seq)
+    return flask.jsonify({'comments': comments_seq, 'next': next_cursor})
 
 
 @check_mimetype
@@ -61,26 +278,25 @@ def new(thread_cid):
     # Create empty `custom_json`, for extensions to populate.
     new_comment['custom_json'] = {}
 
-    # Associate comment with identity
+    # Validate required, type, text length
+    new_comment = forms.validate_new_comment(new_comment)
+
+    # Associate comment with identity, once the comment is valid. Getting
+    # the id of a lazy identity creates the identity, if it does not exist
+    # yet, so rejected comments do not create identities.
     if hasattr(flask.g, 'identity'):
         new_comment['identity_id'] = flask.g.identity['id']
     # Set identity to None if no identity exists in request
     else:
         new_comment['identity_id'] = None
 
-    # Validate required, type, text length
-    new_comment = forms.validate_new_comment(new_comment)
-
-    # Try to fetch the existing thread record, and create a new thread
-    # if one is not found.
-    thread = queries.fetch_thread_by_client_id(thread_cid)
-    if not thread:
-        thread = queries.insert_thread({'client_id': thread_cid})
-
-    new_comment['thread_id'] = thread['id']
-
-    # Insert the comment
-    raw_comment = queries.insert_comment(new_comment)
+    # Insert the comment in the thread, creating the thread if it is not
+    # found. The existence of the parent is checked by the insert.
+    try:
+        raw_comment = queries.insert_comment(
+            new_comment, thread_client_id=thread_cid)
+    except queries.CommentNotFoundError:
+        flask.abort(400, 'parent does not exist')
     client_comment = serialize.to_client_comment(raw_comment)
 
     resp = flask.jsonify(client_comment)
@@ -121,10 +337,7 @@ def edit(comment_id):
     old_comment = queries.fetch_comment_by_id(comment_id)
 
     # Check if does not belong to requesting identity
-    if (
-        not hasattr(flask.g, 'identity')
-        or old_comment['identity_id'] != flask.g.identity['id']
-    ):
+    if not identity.is_owner(old_comment):
         flask.abort(400,
                     'Cannot edit comment: comment belongs to another identity')
 
@@ -165,10 +378,7 @@ def delete(comment_id):
     old_comment = queries.fetch_comment_by_id(comment_id)
 
     # Check if does not belong to requesting identity
-    if (
-        not hasattr(flask.g, 'identity')
-        or old_comment['identity_id'] != flask.g.identity['id']
-    ):
+    if not identity.is_owner(old_comment):
         flask.abort(
             400,
             'Cannot delete comment: this comment belongs to another identity')
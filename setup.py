@@ -6,9 +6,9 @@ from setuptools.command.develop import develop
 PYPY = hasattr(sys, 'pypy_version_info')
 
 requires = [
-    'SQLAlchemy>=1.0',
+    'SQLAlchemy>=1.1',
     'flask>=0.10, <1.0',
-    'alembic>=0.8.0',
+    'alembic>=1.2',
     'Flask-SQLAlchemy>=2.0',
     'Flask-Script>=2.0',
     'Flask-Migrate>=1.5.0',
@@ -17,7 +17,7 @@ requires = [
     'voluptuous>=0.8',
     'stevedore>=1.7',
     'flask-cors>=2.1',
-    'simplejson>=3.8',
+    'simplejson>=3.12',
     'misaka>=2.0.0',
 ]
 
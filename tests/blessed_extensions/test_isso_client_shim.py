@@ -0,0 +1,159 @@
+import datetime
+
+import flask
+import pytest
+import werkzeug.exceptions
+
+from blessed_extensions import isso_client_shim
+
+
+def make_comments():
+    """A thread of comments, with ids in `created` order, given as a list of
+    `(id, parent_id)` pairs."""
+    pairs = [
+        (1, None), (2, 1), (3, 1), (4, 2), (5, None), (6, 1), (7, 4),
+        (8, 5), (9, None), (10, 4), (11, 7), (12, 3), (13, None), (14, 2),
+    ]
+    epoch = datetime.datetime(2015, 1, 1)
+    return [
+        {
+            'id': id,
+            'parent_id': parent_id,
+            'created': epoch + datetime.timedelta(seconds=id),
+        }
+        for id, parent_id in pairs
+    ]
+
+
+def fetch_pruned(comment_seq, reply_limit, depth_limit, parent_id=None,
+                 after=None):
+    """Prune and annotate the comments as the recursive query does."""
+    children = {}
+    for c in comment_seq:
+        children.setdefault(c['parent_id'], []).append(c)
+
+    def count(c):
+        return sum(count(r) + 1 for r in children.get(c['id'], []))
+
+    annotations = {}
+    for siblings in children.values():
+        after_count = 0
+        for c in reversed(siblings):
+            annotations[c['id']] = {
+                'reply_count': count(c),
+                'after_count': after_count,
+            }
+            after_count += annotations[c['id']]['reply_count'] + 1
+
+    kept = []
+
+    def descend(replies, depth):
+        for c in replies[:reply_limit]:
+            annotations[c['id']]['depth'] = depth
+            kept.append(c)
+            if depth <= depth_limit:
+                descend(children.get(c['id'], []), depth + 1)
+    roots = [c for c in children.get(parent_id, [])
+             if after is None or c['created'] > after]
+    descend(roots, 1)
+    kept.sort(key=lambda c: c['id'])
+    reply_count = 0
+    if roots:
+        first_root = annotations[roots[0]['id']]
+        reply_count = first_root['reply_count'] + 1 + first_root['after_count']
+    return kept, annotations, reply_count
+
+
+def expected_tree(comment_seq, reply_limit, depth_limit, parent_id=None,
+                  after=None):
+    """Build the annotated tree that the client expects from the whole
+    thread."""
+    children = {}
+    for c in comment_seq:
+        children.setdefault(c['parent_id'], []).append(c)
+
+    def count(c):
+        return sum(count(r) + 1 for r in children.get(c['id'], []))
+
+    def annotate(replies, depth):
+        counts = [count(r) for r in replies]
+        nodes = []
+        for i, r in enumerate(replies[:reply_limit]):
+            node = dict(r, reply_count=counts[i],
+                        after_count=sum(n + 1 for n in counts[i + 1:]))
+            if depth > depth_limit:
+                node['deeper_replies'] = counts[i]
+            else:
+                node['replies'], hidden = annotate(
+                    children.get(r['id'], []), depth + 1)
+                if hidden:
+                    node['hidden_replies'] = hidden
+            nodes.append(node)
+        hidden = sum(n + 1 for n in counts[reply_limit:])
+        return nodes, hidden
+
+    roots = [c for c in children.get(parent_id, [])
+             if after is None or c['created'] > after]
+    replies, hidden = annotate(roots, 1)
+    tree = {
+        'replies': replies,
+        'reply_count': sum(count(r) + 1 for r in roots),
+    }
+    if hidden:
+        tree['hidden_replies'] = hidden
+    return tree
+
+
+def test_build_pruned_comment_tree():
+    """The tree pruned in the database is annotated with the counts of the
+    whole thread."""
+    for reply_limit in [1, 2, 3, 100]:
+        for depth_limit in [0, 1, 2, 10]:
+            expected = expected_tree(
+                make_comments(), reply_limit, depth_limit)
+            comment_seq, annotations, reply_count = fetch_pruned(
+                make_comments(), reply_limit, depth_limit)
+            actual = isso_client_shim.build_pruned_comment_tree(
+                comment_seq=comment_seq,
+                reply_count=reply_count,
+                comment_annotations=annotations,
+                reply_limit=reply_limit,
+                reply_depth_limit=depth_limit,
+            )
+            assert reply_count == 14
+            assert actual == expected, (reply_limit, depth_limit)
+
+
+def test_build_pruned_comment_tree_from_parent_after():
+    """The tree may be rooted at the replies of a parent created after a
+    given time."""
+    comments = make_comments()
+    cases = [(None, comments[3]['created']), (1, None),
+             (1, comments[2]['created']), (2, comments[5]['created'])]
+    for parent_id, after in cases:
+        for reply_limit in [1, 2, 100]:
+            expected = expected_tree(
+                make_comments(), reply_limit, 1, parent_id, after)
+            comment_seq, annotations, reply_count = fetch_pruned(
+                make_comments(), reply_limit, 1, parent_id, after)
+            actual = isso_client_shim.build_pruned_comment_tree(
+                comment_seq=comment_seq,
+                reply_count=reply_count,
+                comment_annotations=annotations,
+                parent_id=parent_id,
+                reply_limit=reply_limit,
+                reply_depth_limit=1,
+            )
+            assert actual == expected, (parent_id, after, reply_limit)
+
+
+def test_invalid_args():
+    """Invalid and out-of-range arguments are rejected with a 400."""
+    app = flask.Flask('blessed_extensions')
+    for query in ['after=99999999999999999', 'after=1_000', 'parent=a',
+                  'limit=1.5']:
+        with app.test_request_context('/?' + query):
+            with pytest.raises(werkzeug.exceptions.BadRequest):
+                isso_client_shim.get_after()
+                isso_client_shim.get_int_arg('parent')
+                isso_client_shim.get_reply_limit()
@@ -0,0 +1,85 @@
+"""Compare the time to render batches of comments inline and in a pool of
+worker processes, to find the crossover point for `RENDER_POOL_THRESHOLD`.
+
+For each batch size, renders synthetic Markdown comments of a few paragraphs
+with the configured renderer, both inline and with
+:class:`pg_discuss.render_pool.PooledRenderer`, and prints the best time of
+several runs. The crossover point is the smallest batch size for which the
+pool is faster. It depends on the renderer, the length of the comments, and
+the number of cores, so should be measured on the production hardware.
+
+This is not meant to be run as part of the normal regression suite.
+
+    python tests/perf/render_pool.py --processes 4
+"""
+import argparse
+import timeit
+
+import flask
+
+from pg_discuss import config
+from pg_discuss import render_pool
+
+BATCH_SIZES = [100, 250, 500, 1000, 2000, 4000, 8000, 16000, 33000]
+
+COMMENT_TEXT = (
+    'Some *emphasis* and **strong** text, with a [link](http://example.com)'
+    ' and `code`.\n\n'
+    '> A quote of the parent comment, which goes on for a while to make the'
+    ' comment a realistic length.\n\n'
+    '- a list\n- of items\n\n'
+    '```\nfenced code\n```\n'
+)
+
+
+def load_renderer(name):
+    import stevedore
+
+    app = flask.Flask(__name__)
+    app.config.from_object(config)
+    loader = stevedore.DriverManager(namespace='pg_discuss.ext', name=name)
+    return loader.driver(app)
+
+
+def time_render(renderer, texts, repeat):
+    return min(timeit.repeat(
+        lambda: renderer.render_many(texts), number=1, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(usage=(
+        "render_pool.py performance test. See module docstring.\n\n"
+        "render_pool.py [--renderer NAME] [--processes N] [--repeat N]"
+    ))
+    parser.add_argument('--renderer', default=config.DRIVER_COMMENT_RENDERER)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    renderer = load_renderer(args.renderer)
+    pooled = render_pool.PooledRenderer(renderer, args.processes, threshold=0)
+    # Start the workers before timing.
+    pooled.render_many([COMMENT_TEXT] * args.processes)
+
+    print('{0:>8} {1:>10} {2:>10}'.format('comments', 'inline', 'pooled'))
+    crossover = None
+    try:
+        for size in BATCH_SIZES:
+            texts = [COMMENT_TEXT] * size
+            inline_time = time_render(renderer, texts, args.repeat)
+            pooled_time = time_render(pooled, texts, args.repeat)
+            print('{0:>8} {1:>10.4f} {2:>10.4f}'.format(
+                size, inline_time, pooled_time))
+            if crossover is None and pooled_time < inline_time:
+                crossover = size
+    finally:
+        pooled.close()
+
+    if crossover is None:
+        print('The pool was not faster for any batch size.')
+    else:
+        print('The pool was faster from {0} comments.'.format(crossover))
+
+
+if __name__ == '__main__':
+    main()
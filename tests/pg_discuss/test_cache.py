@@ -0,0 +1,62 @@
+from pg_discuss import cache
+
+
+def test_lru_cache_evicts_by_size():
+    """The least recently used values are evicted to stay within the byte
+    bound, and values larger than the bound are not stored."""
+    lru = cache.LRUCache(10)
+    assert lru.set('a', 'a', 4)
+    assert lru.set('b', 'b', 4)
+    assert lru.get('a') == 'a'
+    assert lru.set('c', 'c', 4)
+    assert lru.get('b') is None
+    assert lru.get('a') == 'a'
+    assert lru.size == 8
+    assert not lru.set('d', 'd', 11)
+    assert len(lru) == 2
+
+
+def test_lru_cache_invalidate():
+    lru = cache.LRUCache(100)
+    lru.set('a1', 'a1', 1, tag='a')
+    lru.set('a2', 'a2', 1, tag='a')
+    lru.set('b1', 'b1', 1, tag='b')
+    generation = lru.generation
+    lru.invalidate('a')
+    assert lru.get('a1') is None
+    assert lru.get('a2') is None
+    assert lru.get('b1') == 'b1'
+    assert lru.size == 1
+    # Values computed before the invalidation are not stored.
+    assert not lru.set('a1', 'a1', 1, tag='a', generation=generation)
+    assert lru.set('a1', 'a1', 1, tag='a', generation=lru.generation)
+
+
+def test_lru_cache_disabled():
+    lru = cache.LRUCache(0)
+    assert not lru.set('a', 'a', 1)
+    assert lru.get('a') is None
+
+
+def test_ttl_cache():
+    """Values expire after the TTL, and the least recently set values are
+    evicted to stay within the bound."""
+    now = [0]
+    ttl = cache.TTLCache(2, 10, clock=lambda: now[0])
+    assert ttl.set('a', 'a')
+    now[0] = 5
+    assert ttl.set('b', 'b')
+    assert ttl.get('a') == 'a'
+    now[0] = 10
+    assert ttl.get('a') is None
+    assert ttl.get('b') == 'b'
+    assert ttl.set('c', 'c')
+    assert ttl.set('d', 'd')
+    assert ttl.get('b') is None
+    assert len(ttl) == 2
+    generation = ttl.generation
+    ttl.invalidate('c')
+    assert ttl.get('c') is None
+    # Values computed before the invalidation are not stored.
+    assert not ttl.set('c', 'c', generation=generation)
+    assert not cache.TTLCache(0, 10).set('a', 'a')
@@ -0,0 +1,45 @@
+import flask
+
+from pg_discuss import identity
+
+
+def test_lazy_identity_loads_on_first_access():
+    """The identity is loaded once, when a field is first accessed, and the
+    `on_load` callbacks are called with it."""
+    loads = []
+    remembered = []
+
+    def load():
+        loads.append(1)
+        return {'id': 7, 'custom_json': {}}
+
+    lazy = identity.LazyIdentity(load, new=True)
+    lazy.on_load(lambda i: remembered.append(i['id']))
+    assert lazy
+    assert not lazy.loaded
+    assert loads == []
+
+    assert lazy['id'] == 7
+    assert lazy['custom_json'] == {}
+    assert dict(lazy) == {'id': 7, 'custom_json': {}}
+    assert loads == [1]
+    assert remembered == [7]
+
+    lazy.on_load(lambda i: remembered.append(i['id']))
+    assert remembered == [7, 7]
+
+
+def test_is_owner_does_not_create_identity():
+    app = flask.Flask('pg_discuss')
+    comment = {'identity_id': 7}
+
+    def load():
+        raise AssertionError('identity should not be created')
+
+    with app.test_request_context():
+        assert not identity.is_owner(comment)
+        flask.g.identity = identity.LazyIdentity(load, new=True)
+        assert not identity.is_owner(comment)
+        flask.g.identity = identity.LazyIdentity(lambda: {'id': 7})
+        assert identity.is_owner(comment)
+        assert not identity.is_owner({'identity_id': 8})
@@ -0,0 +1,33 @@
+import json
+import logging
+
+from pg_discuss import invalidation
+
+
+def make_bus():
+    return invalidation.InvalidationBus(
+        'test', False, logging.getLogger(__name__), 0)
+
+
+def test_deliver_to_subscribers():
+    bus = make_bus()
+    received = []
+    resets = []
+    bus.subscribe('thread', received.append, lambda: resets.append(True))
+    bus.publish(('thread', 1), ('comment', 2), ('thread', 3))
+    assert received == [1, 3]
+    bus.reset()
+    assert resets == [True]
+
+
+def test_notifications_from_own_process_are_ignored():
+    """Events published by this process have already been delivered locally,
+    so they are not delivered again when the notification arrives."""
+    bus = make_bus()
+    received = []
+    bus.subscribe('thread', received.append, lambda: None)
+    events = [['thread', 1]]
+    bus._on_notify(json.dumps({'origin': bus.origin, 'events': events}))
+    assert received == []
+    bus._on_notify(json.dumps({'origin': 'other', 'events': events}))
+    assert received == [1]
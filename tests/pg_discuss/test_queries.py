@@ -0,0 +1,92 @@
+import sqlalchemy as sa
+import sqlalchemy.dialects.postgresql
+
+from pg_discuss import queries
+from pg_discuss import tables
+
+
+def test_cte_chain_params():
+    """Parameters of chained statements do not conflict, and are processed
+    for their types."""
+    t_comment = tables.comment
+    values = {
+        'text': u'text',
+        'parent_id': 1,
+        'identity_id': None,
+        'custom_json': {'author': u'a'},
+    }
+    predicates = [t_comment.c.custom_json['archived'].astext == 'false']
+    stmt, bindparams = queries.cte_chain(queries.comment_insert_chain(
+        values, thread_client_id='a', predicates=predicates))
+    assert stmt.startswith('WITH t0 AS (')
+    assert bindparams['t0_custom_json'] == '{"author": "a"}'
+    assert bindparams['t1_client_id'] == 'a'
+    # The predicate is applied to the ancestors of the comment, and to the
+    # comment by two statements.
+    assert bindparams['t0_custom_json_1'] == 'archived'
+    assert bindparams['t1_custom_json_1'] == 'archived'
+    assert bindparams['t3_custom_json_1'] == 'archived'
+    for name in bindparams:
+        assert '%({0})s'.format(name) in stmt
+
+
+def test_comment_insert_chain_computed_values():
+    """Values may be expressions, and callables of the other values, which
+    are computed once in the first statement of the chain."""
+    values = {
+        'id': sa.func.nextval('comment_id_seq'),
+        'text': u'text',
+        'parent_id': None,
+        'identity_id': None,
+        'custom_json': lambda row: sa.func.jsonb_build_object('id', row.id),
+    }
+    stmt, bindparams = queries.cte_chain(queries.comment_insert_chain(
+        values, thread_id=1))
+    first = stmt[:stmt.index(', t1 AS (')]
+    assert first.count('nextval(') == 1
+    assert 'jsonb_build_object(' in first
+    assert 'comment_values.id' in first
+    assert 't0_custom_json' not in bindparams
+    insert = stmt[stmt.index(', t2 AS ('):stmt.index(', t3 AS (')]
+    assert 't0.id' in insert
+    assert bindparams['t0_nextval_1'] == 'comment_id_seq'
+
+
+def test_reply_count_adjustments():
+    """A comment which is shown or hidden is counted in its ancestors up to
+    the first hidden ancestor, and in its thread if no ancestor is hidden."""
+    t_comment = tables.comment
+    predicates = [t_comment.c.custom_json['archived'].astext == 'false']
+    dialect = sa.dialects.postgresql.dialect()
+    update_comments, update_thread = queries.reply_count_adjustments(
+        1, -1, predicates)
+    sql = str(update_comments.compile(dialect=dialect))
+    step = sql[sql.index('UNION ALL'):sql.index('UPDATE')]
+    assert 'parent.custom_json ->>' in step
+    sql = str(update_thread.compile(dialect=dialect))
+    assert 'NOT (EXISTS (SELECT 1' in sql
+    assert 'chain.visible IS NOT true' in sql
+
+
+def test_comment_insert_chain_parent_thread():
+    """The parent of a reply, and the ancestors counting it, must be in the
+    thread of the reply."""
+    values = {
+        'text': u'text',
+        'parent_id': 1,
+        'identity_id': None,
+        'custom_json': {},
+    }
+    stmt, bindparams = queries.cte_chain(queries.comment_insert_chain(
+        values, thread_id=2))
+    first = stmt[:stmt.index(', t1 AS (')]
+    assert 'comment.thread_id = %(t0_thread_id_1)s' in first
+    assert bindparams['t0_thread_id_1'] == 2
+    walk = stmt[stmt.index(', t3 AS ('):]
+    assert 'comment.thread_id = counted.thread_id' in walk
+    assert 'parent.thread_id = ancestors.thread_id' in walk
+    stmt, bindparams = queries.cte_chain(queries.comment_insert_chain(
+        values, thread_client_id='a'))
+    first = stmt[:stmt.index(', t1 AS (')]
+    assert 'WHERE thread.client_id = %(t0_client_id_1)s' in first
+    assert bindparams['t0_client_id_1'] == 'a'
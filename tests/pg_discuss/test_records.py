@@ -0,0 +1,46 @@
+import simplejson as json
+
+from pg_discuss import records
+
+
+def test_record_mapping():
+    """Records behave as dicts, and keys added to one record are added to the
+    shared columns without being set on the other records."""
+    a, b = records.Record.from_rows(['id', 'text'], [(1, 'a'), (2, 'b')])
+    assert a == {'id': 1, 'text': 'a'}
+    a['parent'] = a.pop('id')
+    assert a == {'text': 'a', 'parent': 1}
+    assert 'id' not in a
+    assert a.get('id') is None
+    assert 'parent' not in b
+    assert b.get('parent', 0) == 0
+    assert list(b) == ['id', 'text']
+    assert len(a) == 2
+    b.update({'parent': 1, 'replies': []})
+    assert dict(b) == {'id': 2, 'text': 'b', 'parent': 1, 'replies': []}
+    del b['replies']
+    assert b.for_json() == {'id': 2, 'text': 'b', 'parent': 1}
+
+
+def test_record_json_encoder():
+    encoder_cls = records.json_encoder(json.JSONEncoder)
+    columns = records.Columns(['id', 'replies'])
+    record = records.Record(columns, [1, []])
+    record['replies'].append(records.Record(columns, [2]))
+    expected = {'id': 1, 'replies': [{'id': 2}]}
+    assert json.loads(encoder_cls().encode({'comments': [record]})) == {
+        'comments': [expected]}
+
+
+def test_fragment_record():
+    """Keys set on a fragment record are spliced into its fragment."""
+    encoder = records.json_encoder(json.JSONEncoder)()
+    record = records.Record.from_rows(['id', 'text'], [(1, 'a')])[0]
+    fragment_record = records.FragmentRecord.from_record(record, encoder)
+    assert fragment_record.encode_with(encoder) == fragment_record.fragment
+    fragment_record['replies'] = [fragment_record.copy()]
+    assert json.loads(encoder.encode(fragment_record)) == {
+        'id': 1, 'text': 'a', 'replies': [{'id': 1, 'text': 'a'}]}
+    fragment_record['text'] = 'b'
+    assert fragment_record.encode_with(encoder) is None
+    assert json.loads(encoder.encode(fragment_record))['text'] == 'b'
@@ -0,0 +1,18 @@
+from pg_discuss import render_pool
+from pg_discuss.drivers import escaping_renderer
+
+
+def test_pooled_renderer():
+    """Large batches are rendered in the worker pool in the same order as
+    inline, and small batches are rendered inline."""
+    renderer = escaping_renderer.EscapingRenderer()
+    pooled = render_pool.PooledRenderer(renderer, processes=2, threshold=10)
+    texts = [u'<b>{0}</b> & more'.format(i) for i in range(25)]
+    try:
+        assert pooled.render_many(texts[:5]) == renderer.render_many(texts[:5])
+        assert pooled._pool is None
+        assert pooled.render_many(texts) == renderer.render_many(texts)
+        assert pooled._pool is not None
+        assert pooled.render_key() == renderer.render_key()
+    finally:
+        pooled.close()
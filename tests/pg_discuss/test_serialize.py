@@ -0,0 +1,246 @@
+import simplejson as json
+
+from pg_discuss import cache
+from pg_discuss import ext
+from pg_discuss import records
+from pg_discuss import serialize
+from pg_discuss.drivers import escaping_renderer
+
+
+def test_iterencode_chunks():
+    """Encoding incrementally produces the same document as encoding at once,
+    split in to multiple chunks."""
+    encoder = json.JSONEncoder(sort_keys=True)
+    obj = {
+        'id': 1,
+        'client_id': 'thread',
+        'comments': [{'id': i, 'text': u'caf\xe9'} for i in range(1000)],
+        'empty': [],
+    }
+    chunks = list(serialize.iterencode_chunks(encoder, obj, chunk_size=1024))
+    assert len(chunks) > 1
+    assert all(isinstance(c, bytes) for c in chunks)
+    assert b''.join(chunks) == encoder.encode(obj).encode('utf-8')
+
+
+def test_iterencode_chunks_generator():
+    """A generator is encoded as a list, and consumed lazily."""
+    encoder = json.JSONEncoder(sort_keys=True)
+    consumed = []
+
+    def comments():
+        for i in range(1000):
+            consumed.append(i)
+            yield {'id': i}
+
+    obj = {'id': 1, 'comments': comments()}
+    chunks = serialize.iterencode_chunks(encoder, obj, chunk_size=1024)
+    first = next(chunks)
+    assert len(consumed) < 1000
+    expected = {'id': 1, 'comments': [{'id': i} for i in range(1000)]}
+    assert first + b''.join(chunks) == encoder.encode(expected).encode('utf-8')
+
+
+def test_iterencode_chunks_deep_tree():
+    """Replies nested beyond the recursion limit are encoded without
+    recursion."""
+    encoder = json.JSONEncoder()
+    depth = 5000
+    root = node = {'id': 0, 'replies': []}
+    for i in range(1, depth):
+        reply = {'id': i, 'replies': []}
+        node['replies'].append(reply)
+        node = reply
+    obj = {'replies': [root, {'id': depth}]}
+    chunks = serialize.iterencode_chunks(encoder, obj, chunk_size=1024)
+    expected = (
+        '{"replies": ['
+        + ''.join('{"id": %d, "replies": [' % i for i in range(depth - 1))
+        + '{"id": %d, "replies": []}' % (depth - 1)
+        + ']}' * (depth - 1)
+        + ', {"id": %d}]}' % depth
+    )
+    assert b''.join(chunks) == expected.encode('utf-8')
+
+
+class Renderer(ext.CommentRenderer):
+    def render(self, text, **extras):
+        return '<p>{0}</p>'.format(text)
+
+
+class AddFields(ext.OnPreCommentSerialize):
+    serialized_fields = {'author': str, 'votes': int}
+
+    def on_pre_comment_serialize(self, raw_comment, client_comment, **extras):
+        client_comment['author'] = raw_comment['custom_json']['author']
+        client_comment['votes'] = raw_comment['custom_json']['votes']
+
+
+def test_comment_serializer():
+    """Declared string fields are escaped, and text is rendered unless it was
+    rendered by the same renderer when written."""
+    renderer = Renderer()
+    serializer = serialize.CommentSerializer([AddFields()], renderer)
+    assert serializer.escape_fields == ('author', 'deleted')
+    raw_comment = {
+        'id': 1,
+        'thread_id': 1,
+        'parent_id': None,
+        'created': None,
+        'modified': None,
+        'text': '<b>',
+        'rendered_text': None,
+        'rendered_key': None,
+        'reply_count': 0,
+        'custom_json': {'author': '<i>', 'votes': 2, 'deleted': True},
+    }
+    client_comment = serializer.serialize(raw_comment)
+    assert client_comment['author'] == '&lt;i&gt;'
+    assert client_comment['votes'] == 2
+    assert client_comment['deleted'] is True
+    assert client_comment['text'] == '<p><b></p>'
+    assert serializer.serialize(raw_comment, plain=True)['text'] == '<b>'
+    raw_comment.update(rendered_text='cached',
+                       rendered_key=renderer.render_key())
+    assert serializer.serialize(raw_comment)['text'] == 'cached'
+    raw_comment['custom_json']['deleted'] = '<s>'
+    assert serializer.serialize(raw_comment)['deleted'] == '&lt;s&gt;'
+
+
+def test_comment_serializer_undeclared_fields():
+    """If a hook does not declare its fields, every field is escaped."""
+    hook = AddFields()
+    hook.serialized_fields = None
+    serializer = serialize.CommentSerializer([hook], Renderer())
+    assert serializer.escape_fields is None
+
+
+class RenameVotes(ext.OnPreCommentSerialize, ext.OnPreCommentsSerialize):
+    serialized_fields = {'likes': int}
+
+    def on_pre_comment_serialize(self, raw_comment, client_comment, **extras):
+        raise AssertionError('The batch hook is preferred')
+
+    def on_pre_comments_serialize(self, raw_comments, client_comments,
+                                  **extras):
+        for client_comment in client_comments:
+            client_comment['likes'] = client_comment.pop('votes')
+
+
+def test_comment_serializer_batch_hooks():
+    """Batch and single comment hooks are called in extension order."""
+    serializer = serialize.CommentSerializer(
+        [AddFields(), RenameVotes()], Renderer())
+    raw_comments = [{
+        'id': i,
+        'thread_id': 1,
+        'parent_id': None,
+        'created': None,
+        'modified': None,
+        'text': 'text',
+        'reply_count': 0,
+        'custom_json': {'author': 'a', 'votes': i},
+    } for i in range(5)]
+    client_comments = list(serializer.serialize_iter(raw_comments, 2))
+    assert [c['likes'] for c in client_comments] == list(range(5))
+    assert 'votes' not in client_comments[0]
+    assert serializer.serialize(raw_comments[1])['likes'] == 1
+
+
+class CountingRenderer(escaping_renderer.EscapingRenderer):
+    calls = 0
+
+    def render_many(self, texts, **extras):
+        self.calls += 1
+        return super(CountingRenderer, self).render_many(texts)
+
+
+def test_comment_serializer_render_many():
+    """Comments without current rendered text are rendered in one call."""
+    renderer = CountingRenderer()
+    serializer = serialize.CommentSerializer([], renderer)
+    texts = [u'<a>', u'', u'a & b', u'caf\xe9 "q"']
+    raw_comments = [{
+        'id': i,
+        'thread_id': 1,
+        'parent_id': None,
+        'created': None,
+        'modified': None,
+        'text': text,
+        'rendered_text': u'cached' if i == 0 else None,
+        'rendered_key': renderer.render_key(),
+        'reply_count': 0,
+        'custom_json': {},
+    } for i, text in enumerate(texts)]
+    client_comments = serializer.serialize_many(raw_comments)
+    assert renderer.calls == 1
+    assert [c['text'] for c in client_comments] == (
+        [u'cached'] + [renderer.render(t) for t in texts[1:]])
+
+
+class FlaggedRenderer(Renderer):
+    def __init__(self, flags):
+        self.flags = flags
+
+    def render_key(self, **extras):
+        return 'flagged:{0}'.format(self.flags)
+
+
+def test_comment_serializer_fingerprint():
+    """The fingerprint changes with the render key and the serialization
+    hooks, but not between serializers of the same configuration."""
+    fingerprint = serialize.CommentSerializer(
+        [], FlaggedRenderer('a')).fingerprint
+    assert fingerprint == serialize.CommentSerializer(
+        [], FlaggedRenderer('a')).fingerprint
+    assert fingerprint != serialize.CommentSerializer(
+        [], FlaggedRenderer('b')).fingerprint
+    assert fingerprint != serialize.CommentSerializer(
+        [AddFields()], FlaggedRenderer('a')).fingerprint
+
+
+def test_comment_serializer_fragment_cache():
+    """Unchanged comments are served from the cache without being serialized
+    again, and encode to the same JSON as freshly serialized comments, with
+    any fields set after serialization."""
+    renderer = CountingRenderer()
+    encoder_cls = records.json_encoder(json.JSONEncoder)
+    encoder = encoder_cls(sort_keys=True)
+    serializer = serialize.CommentSerializer(
+        [AddFields()], renderer,
+        fragment_cache=cache.LRUCache(2 ** 20), encoder=encoder)
+
+    def raw_comments(versions):
+        return [{
+            'id': i,
+            'thread_id': 1,
+            'parent_id': None,
+            'created': None,
+            'modified': None,
+            'text': u'text & %i' % i,
+            'reply_count': 0,
+            'custom_json': {'author': u'<b>', 'votes': 1},
+            'row_version': version,
+        } for i, version in enumerate(versions)]
+
+    first = serializer.serialize_many(raw_comments(['1', '1', None]))
+    assert renderer.calls == 1
+    second = serializer.serialize_many(raw_comments(['1', '2', None]))
+    # Only the changed comment and the comment without a version are
+    # rendered again.
+    assert renderer.calls == 2
+    assert second[0].fragment is first[0].fragment
+    assert second[1].fragment is not first[1].fragment
+
+    uncached = serialize.CommentSerializer([AddFields()], renderer)
+    expected = uncached.serialize_many(raw_comments(['1', '1', None]))
+    # Uncached client comments are plain dicts, which the encoder encodes
+    # without calling `default`.
+    assert type(expected[0]) is dict
+    for c in (second[0], expected[0]):
+        c['replies'] = [{'id': 3}]
+    assert (json.loads(encoder.encode(second))
+            == json.loads(encoder.encode(expected)))
+    # Fields changed since serialization are encoded with the whole comment.
+    second[0]['reply_count'] = 1
+    assert json.loads(encoder.encode(second[0]))['reply_count'] == 1
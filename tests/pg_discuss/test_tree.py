@@ -0,0 +1,48 @@
+import sys
+
+from pg_discuss import tree
+
+
+def make_comments(pairs):
+    """Comments with ids in `created` order, from `(id, parent_id)` pairs."""
+    return [{'id': id, 'parent_id': parent_id, 'created': id}
+            for id, parent_id in pairs]
+
+
+def ids(node):
+    return [r['id'] for r in node['replies']]
+
+
+def test_build():
+    comments = make_comments([
+        (1, None), (2, 1), (3, 1), (4, 2), (5, None), (6, 1), (7, 4),
+    ])
+    root = tree.build(comments)
+    assert ids(root) == [1, 5]
+    assert ids(comments[0]) == [2, 3, 6]
+    assert ids(comments[1]) == [4]
+    assert [(n.get('id'), depth) for n, depth in tree.walk(root)] == [
+        (None, 0), (1, 1), (2, 2), (4, 3), (7, 4), (3, 2), (6, 2), (5, 1),
+    ]
+
+
+def test_build_from_parent():
+    """The tree of the replies to a parent may be built from only the
+    subtree of the parent. Comments outside of the subtree are left out."""
+    comments = make_comments([(2, 1), (4, 2), (5, None), (6, 1), (7, 4)])
+    root = tree.build(comments, parent_id=1)
+    assert ids(root) == [2, 6]
+    assert ids(comments[0]) == [4]
+    assert [n.get('id') for n, depth in tree.walk(root)] == [
+        None, 2, 4, 7, 6]
+
+
+def test_build_deep_thread():
+    """Threads nested deeper than the recursion limit are built and
+    walked."""
+    depth = sys.getrecursionlimit() * 2
+    comments = make_comments(
+        [(1, None)] + [(i, i - 1) for i in range(2, depth + 1)])
+    root = tree.build(comments)
+    assert comments[-2]['replies'] == [comments[-1]]
+    assert max(d for n, d in tree.walk(root)) == depth
@@ -0,0 +1,60 @@
+import datetime
+
+import pytest
+
+from pg_discuss import utils
+
+
+class UTC(datetime.tzinfo):
+    def utcoffset(self, dt):
+        return datetime.timedelta(0)
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+
+def test_timestamp_round_trip():
+    """Datetimes survive conversion to a timestamp string and back with
+    microsecond precision."""
+    dt = datetime.datetime(2015, 10, 16, 12, 53, 20, 123456, tzinfo=UTC())
+    timestamp = utils.datetime_to_timestamp(dt)
+    assert timestamp == '1445000000.123456'
+    assert utils.timestamp_to_datetime(timestamp) == dt.replace(tzinfo=None)
+
+
+def test_timestamp_to_datetime_fraction():
+    assert utils.timestamp_to_datetime('10') == datetime.datetime(
+        1970, 1, 1, 0, 0, 10)
+    assert utils.timestamp_to_datetime('10.5') == datetime.datetime(
+        1970, 1, 1, 0, 0, 10, 500000)
+
+
+def test_timestamp_to_datetime_negative_fraction():
+    """The fraction of a negative timestamp is negative too."""
+    assert utils.timestamp_to_datetime('-1.5') == datetime.datetime(
+        1969, 12, 31, 23, 59, 58, 500000)
+    assert utils.timestamp_to_datetime('-0.5') == datetime.datetime(
+        1969, 12, 31, 23, 59, 59, 500000)
+    assert utils.timestamp_to_datetime('-0') == datetime.datetime(1970, 1, 1)
+    dt = datetime.datetime(1969, 12, 31, 23, 59, 58, 500000, tzinfo=UTC())
+    timestamp = utils.datetime_to_timestamp(dt)
+    assert timestamp == '-1.500000'
+    assert utils.timestamp_to_datetime(timestamp) == dt.replace(tzinfo=None)
+
+
+def test_timestamp_to_datetime_invalid():
+    with pytest.raises(ValueError):
+        utils.timestamp_to_datetime('ten')
+    with pytest.raises(ValueError):
+        utils.timestamp_to_datetime('10.-5')
+    for timestamp in [' 10', '10 ', '1_000', '10.', '.5', '10\n', '+10']:
+        with pytest.raises(ValueError):
+            utils.timestamp_to_datetime(timestamp)
+
+
+def test_timestamp_to_datetime_out_of_range():
+    """Timestamps beyond the range of `datetime` raise `ValueError`, not
+    `OverflowError`."""
+    for timestamp in ['99999999999999999', '1000000000000', '-99999999999']:
+        with pytest.raises(ValueError):
+            utils.timestamp_to_datetime(timestamp)